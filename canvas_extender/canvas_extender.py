@@ -2,18 +2,74 @@ from krita import Krita, DockWidget, DockWidgetFactoryBase
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QSizePolicy, QApplication, 
                              QToolButton, QHBoxLayout, QLabel, QSplitter, 
                              QStackedLayout, QComboBox, QCheckBox, QOpenGLWidget,
-                             QAbstractScrollArea, QMdiArea, QSlider, QColorDialog, QPushButton)
-from PyQt5.QtCore import Qt, QTimer, QObject, QEvent, QPointF, QPoint, QRect, QRectF, pyqtSignal, QSize
-from PyQt5.QtGui import QPainter, QPen, QPixmap, QColor, QImage, QBrush, QPainterPath, QTransform
+                             QAbstractScrollArea, QMdiArea, QSlider, QColorDialog, QPushButton,
+                             QSpinBox, QFileDialog, QProgressDialog)
+from PyQt5.QtCore import (Qt, QTimer, QObject, QEvent, QPointF, QPoint, QRect, QRectF, pyqtSignal, QSize,
+                          QAbstractEventDispatcher)
+from PyQt5.QtGui import QPainter, QPen, QPixmap, QColor, QImage, QBrush, QPainterPath, QTransform, QRegion
 import time
 import json
 import os
-from math import cos, sin, ceil
+import struct
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+
+try:
+    from PyQt5 import sip
+except ImportError:
+    import sip
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # --- CONFIGURACIÓN ---
 BASE_CAMERA_SIZE = 200
 GRID_SIZE = 12
 MAX_BUFFER_SIZE = 2500 
+TILE_SIZE = 256
+TILE_POOL_SIZE = 32
+FRAME_INTERVAL_MS = 16
+OCCUPANCY_TILE_SIZE = 64
+OCCUPANCY_BAND_PIXELS = 4 * 1024 * 1024
+PIXEL_BROKER_BUDGET_BYTES = 256 * 1024 * 1024
+PIXEL_MERGE_WASTE = 0.25
+PARALLEL_MIN_PIXELS = 1024 * 1024
+PARALLEL_MIN_STRIP = 64
+PREFETCH_TILE_SIZE = 64
+PREFETCH_MAX_TILES = 512
+PREFETCH_SETTLE_S = 0.15
+PREFETCH_LOOKAHEAD_S = 0.03
+SYNC_INTERVAL_MS = 16
+SYNC_MAX_INTERVAL_MS = 500
+MONITOR_INTERVAL_MS = 100
+MONITOR_MAX_INTERVAL_MS = 2000
+IDLE_BACKOFF_AFTER_S = 2.0
+IDLE_STATS_WINDOW_S = 10.0
+COLD_TILE_SIZE = 256
+COLD_TIER_ZLIB_LEVEL = 1
+RASTER_CACHE_TILE_SIZE = 256
+RASTER_CACHE_BUDGET_BYTES = 64 * 1024 * 1024
+RASTER_COLD_BUDGET_BYTES = 256 * 1024 * 1024
+RASTERIZED_LAYER_TYPES = ("vectorlayer", "filllayer", "filelayer", "clonelayer")
+FRAME_CACHE_BUDGET_BYTES = 128 * 1024 * 1024
+FRAME_COLD_BUDGET_BYTES = 256 * 1024 * 1024
+EXPORT_BAND_PIXELS = 4 * 1024 * 1024
+EXPORT_IDAT_SIZE = 256 * 1024
+EXPORT_PNG_LEVEL = 6
+CAPTURE_MIN_SIZE = 16
+CAPTURE_MAX_SIZE = 4096
+CAPTURE_PRESSURE_WEIGHT = 0.5
+CAPTURE_MARGIN_FACTORS = {1: 1.25, 3: 2.0, 5: 3.0}   # Normal / Wide / Ultra
+BRUSH_SIZE_REFRESH_S = 0.25
+
+INPUT_EVENT_TYPES = (QEvent.MouseButtonPress, QEvent.MouseButtonRelease, QEvent.MouseMove,
+                     QEvent.TabletPress, QEvent.TabletRelease, QEvent.TabletMove)
+ACTIVITY_EVENT_TYPES = INPUT_EVENT_TYPES + (QEvent.Wheel, QEvent.KeyPress, QEvent.KeyRelease,
+                                            QEvent.TouchBegin, QEvent.TouchUpdate, QEvent.NativeGesture)
 
 # Mapeo de modos de fusión
 BLEND_MODES_MAP = {
@@ -33,22 +89,1340 @@ BLEND_MODES_MAP = {
     'xor': QPainter.CompositionMode_Xor,
 }
 
+# =========================================================================================
+# TILES DISPERSOS (buffers de trazo)
+# =========================================================================================
+class SparseTileBuffer:
+    # Solo se reservan tiles donde se estampa un parche; limpiar y pintar
+    # cuesta O(tiles tocados) en vez de O(tamaño del buffer).
+    def __init__(self, width=0, height=0, tile_size=TILE_SIZE):
+        self.tile_size = tile_size
+        self.tiles = {}
+        self._pool = []
+        self._width = 0
+        self._height = 0
+        self.resize(width, height)
+
+    def width(self): return self._width
+    def height(self): return self._height
+    def size(self): return QSize(self._width, self._height)
+
+    def resize(self, width, height):
+        self._width = max(0, int(width))
+        self._height = max(0, int(height))
+        self.clear()
+
+    def is_empty(self):
+        return not self.tiles
+
+    def bounds(self):
+        ts = self.tile_size
+        rect = QRect()
+        for tx, ty in self.tiles:
+            rect = rect.united(QRect(tx * ts, ty * ts, ts, ts))
+        return rect
+
+    def clear(self):
+        for pixmap in self.tiles.values():
+            if len(self._pool) < TILE_POOL_SIZE:
+                self._pool.append(pixmap)
+        self.tiles.clear()
+
+    def _acquire_tile(self):
+        pixmap = self._pool.pop() if self._pool else QPixmap(self.tile_size, self.tile_size)
+        pixmap.fill(Qt.transparent)
+        return pixmap
+
+    def _tile_keys(self, rect):
+        if self._width > 0 and self._height > 0:
+            rect = rect.intersected(QRect(0, 0, self._width, self._height))
+        if rect.isEmpty(): return []
+        ts = self.tile_size
+        tx0, ty0 = rect.left() // ts, rect.top() // ts
+        tx1, ty1 = rect.right() // ts, rect.bottom() // ts
+        return [(tx, ty) for ty in range(ty0, ty1 + 1) for tx in range(tx0, tx1 + 1)]
+
+    def stamp(self, image, target):
+        # target: QRect/QRectF en coordenadas del buffer. Devuelve el rect afectado.
+        target = QRectF(target)
+        dirty = target.toAlignedRect()
+        keys = self._tile_keys(dirty)
+        ts = self.tile_size
+        for key in keys:
+            pixmap = self.tiles.get(key)
+            if pixmap is None:
+                pixmap = self._acquire_tile()
+                self.tiles[key] = pixmap
+            painter = QPainter(pixmap)
+            painter.setRenderHint(QPainter.Antialiasing, False)
+            painter.setRenderHint(QPainter.SmoothPixmapTransform, False)
+            painter.setCompositionMode(QPainter.CompositionMode_Source)
+            painter.setTransform(QTransform.fromTranslate(-key[0] * ts, -key[1] * ts))
+            painter.drawImage(target.toRect(), image)
+            painter.end()
+        return dirty
+
+    def draw(self, painter, x=0, y=0, scale=1.0, clip_rect=None):
+        # Pinta solo los tiles vivos; clip_rect (coordenadas del buffer) descarta el resto.
+        if not self.tiles: return
+        ts = self.tile_size
+        painter.save()
+        painter.translate(x, y)
+        if scale != 1.0:
+            painter.scale(scale, scale)
+        if self._width > 0 and self._height > 0:
+            painter.setClipRect(QRect(0, 0, self._width, self._height), Qt.IntersectClip)
+        for (tx, ty), pixmap in self.tiles.items():
+            if clip_rect is not None and not clip_rect.intersects(QRect(tx * ts, ty * ts, ts, ts)):
+                continue
+            painter.drawPixmap(tx * ts, ty * ts, pixmap)
+        painter.restore()
+
+# =========================================================================================
+# PRESENTACIÓN (un repintado por frame)
+# =========================================================================================
+class PresentationScheduler(QObject):
+    # Junta las peticiones de repintado de preview, viewport y overlay y las
+    # despacha como mucho una vez por frame de pantalla.
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.dirty = {}
+        self.requests = 0
+        self.frames = 0
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(self._frame_interval())
+        self.timer.timeout.connect(self.flush)
+
+    def _frame_interval(self):
+        try:
+            rate = QApplication.primaryScreen().refreshRate()
+            if rate and rate > 0:
+                return max(1, int(1000.0 / rate))
+        except Exception:
+            pass
+        return FRAME_INTERVAL_MS
+
+    def request(self, widget, rect=None):
+        self.requests += 1
+        if widget in self.dirty:
+            region = self.dirty[widget]
+            if region is not None:
+                self.dirty[widget] = None if rect is None else region.united(QRegion(rect))
+        else:
+            self.dirty[widget] = None if rect is None else QRegion(rect)
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def forget(self, widget):
+        self.dirty.pop(widget, None)
+
+    def flush(self):
+        pending = self.dirty
+        self.dirty = {}
+        if pending:
+            self.frames += 1
+        for widget, region in pending.items():
+            try:
+                if region is None: widget.update()
+                else: widget.update(region)
+            except RuntimeError:
+                pass
+
+def schedule_update(widget, rect=None):
+    scheduler = getattr(widget, "scheduler", None)
+    if scheduler is not None:
+        scheduler.request(widget, rect)
+    elif rect is None:
+        widget.update()
+    else:
+        widget.update(rect)
+
+# =========================================================================================
+# OCUPACIÓN POR TILES (bounds ajustados)
+# =========================================================================================
+def node_key(node):
+    try: return node.uniqueId().toString()
+    except Exception: return id(node)
+
+def node_ancestors(node):
+    # Grupos que contienen a node, del más cercano a la raíz
+    try: parent = node.parentNode()
+    except Exception: return
+    while parent is not None:
+        yield parent
+        parent = parent.parentNode()
+
+def decode_layer_pixels(pixel_data, w, h):
+    # pixelData (BGRA 8 o 16 bits por canal) -> QImage ARGB32 premultiplicado
+    if not pixel_data: return None
+    expected_len = w * h
+    layer_img = None
+    if len(pixel_data) == expected_len * 4:
+        layer_img = QImage(pixel_data, w, h, QImage.Format_RGBA8888).rgbSwapped()
+    elif len(pixel_data) == expected_len * 8:
+        layer_img = QImage(pixel_data, w, h, w * 8, QImage.Format_RGBA64).rgbSwapped()
+    if layer_img is None or layer_img.isNull(): return None
+    if layer_img.format() != QImage.Format_ARGB32_Premultiplied:
+        layer_img = layer_img.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+    return layer_img
+
+def tile_row_runs(tiles):
+    # (tx, ty) -> tramos horizontales contiguos (ty, tx_inicio, tx_fin)
+    rows = {}
+    for tx, ty in tiles:
+        rows.setdefault(ty, []).append(tx)
+    for ty, xs in sorted(rows.items()):
+        xs.sort()
+        start = prev = xs[0]
+        for tx in xs[1:]:
+            if tx != prev + 1:
+                yield ty, start, prev + 1
+                start = tx
+            prev = tx
+        yield ty, start, prev + 1
+
+class TileOccupancyIndex:
+    # Por capa guarda qué tiles de OCCUPANCY_TILE_SIZE tienen algún alfa != 0.
+    # Se construye leyendo la capa por bandas y se actualiza con las zonas
+    # sucias de los trazos; da bounds ajustados al contenido real y permite
+    # saltarse los tiles totalmente transparentes al proyectar. Es solo una
+    # pista: filtros, rellenos o lo pintado sin seguimiento cambian píxeles
+    # fuera de esas zonas, así que cada proyección forzada lee las capas
+    # enteras y rehace el índice con esos mismos bytes (record).
+    def __init__(self, tile_size=OCCUPANCY_TILE_SIZE, broker=None):
+        self.tile_size = tile_size
+        self.broker = broker
+        self.layers = {}
+
+    def invalidate(self, node=None):
+        if node is None: self.layers.clear()
+        else: self.layers.pop(node_key(node), None)
+
+    def record(self, node, chunks):
+        # chunks: [(rect, pixel_data)] recién leídos de la capa. Si cubren sus
+        # bounds la entrada se rehace entera; si no, solo se añaden tiles
+        # ocupados y se vacían los que quedan dentro de un rect leído.
+        bounds = node.bounds()
+        key = node_key(node)
+        covered = QRegion()
+        found = []
+        for rect, data in chunks:
+            tiles = self._occupied_tiles(data, rect)
+            if tiles is None:
+                entry = self.layers.get(key)
+                if entry is not None: entry["scannable"] = False
+                return
+            found.append((rect, tiles))
+            covered = covered.united(QRegion(rect))
+        ts = self.tile_size
+        entry = self.layers.get(key)
+        if QRegion(bounds).subtracted(covered).isEmpty():
+            entry = {"bounds": QRect(bounds), "tiles": set(), "dirty": [], "dirty_tiles": set(),
+                     "scannable": True, "content": None}
+            self.layers[key] = entry
+        elif entry is None or entry["bounds"] != bounds:
+            return
+        tiles = entry["tiles"]
+        for rect, occupied in found:
+            tx0, ty0 = -(-rect.left() // ts), -(-rect.top() // ts)
+            tx1, ty1 = (rect.right() + 1) // ts, (rect.bottom() + 1) // ts
+            for ty in range(ty0, ty1):
+                for tx in range(tx0, tx1):
+                    tiles.discard((tx, ty))
+            tiles.update(t for t in occupied if bounds.intersects(QRect(t[0] * ts, t[1] * ts, ts, ts)))
+        entry["content"] = None
+
+    def mark_dirty(self, node, rect):
+        for target in (node, *node_ancestors(node)):
+            entry = self.layers.get(node_key(target))
+            if entry is not None:
+                self._add_dirty(entry, rect)
+
+    def _add_dirty(self, entry, rect):
+        # Hasta el siguiente escaneo los tiles sucios cuentan como ocupados
+        rect = QRect(rect)
+        if rect.isEmpty(): return
+        entry["dirty"].append(rect)
+        ts = self.tile_size
+        for ty in range(rect.top() // ts, rect.bottom() // ts + 1):
+            for tx in range(rect.left() // ts, rect.right() // ts + 1):
+                entry["dirty_tiles"].add((tx, ty))
+        entry["content"] = None
+
+    def content_bounds(self, node):
+        entry = self._sync(node)
+        if entry is None: return node.bounds()
+        if entry["content"] is None:
+            ts = self.tile_size
+            rect = QRect()
+            for tx, ty in entry["tiles"]:
+                rect = rect.united(QRect(tx * ts, ty * ts, ts, ts))
+            entry["content"] = rect.intersected(entry["bounds"])
+        return entry["content"]
+
+    def occupied_rects(self, node, rect):
+        # Rectángulos (tramos de tiles ocupados por fila) dentro de rect. No
+        # reescanea: durante un trazo las zonas sucias se leen enteras.
+        entry = self._sync(node, rescan=False)
+        if entry is None: return [rect]
+        ts = self.tile_size
+        tx0, ty0 = rect.left() // ts, rect.top() // ts
+        tx1, ty1 = rect.right() // ts, rect.bottom() // ts
+        tiles = entry["tiles"]
+        dirty_tiles = entry["dirty_tiles"]
+        total = (tx1 - tx0 + 1) * (ty1 - ty0 + 1)
+        rects = []
+        occupied = 0
+        for ty in range(ty0, ty1 + 1):
+            run_start = None
+            for tx in range(tx0, tx1 + 2):
+                filled = tx <= tx1 and ((tx, ty) in tiles or (tx, ty) in dirty_tiles)
+                if filled:
+                    occupied += 1
+                    if run_start is None: run_start = tx
+                elif run_start is not None:
+                    run = QRect(run_start * ts, ty * ts, (tx - run_start) * ts, ts)
+                    rects.append(run.intersected(rect))
+                    run_start = None
+        # Casi todo ocupado: una sola lectura sale más barata que muchas pequeñas
+        if occupied * 4 >= total * 3: return [rect] if occupied else []
+        return rects
+
+    def _sync(self, node, rescan=True):
+        bounds = node.bounds()
+        key = node_key(node)
+        entry = self.layers.get(key)
+        if entry is None:
+            if not rescan: return None
+            entry = {"bounds": QRect(bounds), "tiles": set(), "dirty": [], "dirty_tiles": set(),
+                     "scannable": True, "content": None}
+            self.layers[key] = entry
+            if not bounds.isEmpty():
+                self._scan(node, entry, bounds)
+        elif bounds != entry["bounds"]:
+            old_bounds = entry["bounds"]
+            entry["bounds"] = QRect(bounds)
+            ts = self.tile_size
+            entry["tiles"] = {t for t in entry["tiles"]
+                              if bounds.intersects(QRect(t[0] * ts, t[1] * ts, ts, ts))}
+            entry["content"] = None
+            if old_bounds.isEmpty():
+                self._add_dirty(entry, bounds)
+            else:
+                for rect in QRegion(bounds).subtracted(QRegion(old_bounds)).rects():
+                    self._add_dirty(entry, rect)
+        if rescan and entry["dirty"]:
+            # Se reescanea por tramos de tiles sucios: los rects de un trazo se solapan mucho
+            dirty_tiles = entry["dirty_tiles"]
+            entry["dirty"] = []
+            entry["dirty_tiles"] = set()
+            ts = self.tile_size
+            runs = [QRect(tx_start * ts, ty * ts, (tx_end - tx_start) * ts, ts).intersected(bounds)
+                    for ty, tx_start, tx_end in tile_row_runs(dirty_tiles)]
+            for region, _, _ in merge_rects([run for run in runs if not run.isEmpty()]):
+                self._scan(node, entry, region)
+        if not entry["scannable"]: return None
+        return entry
+
+    def _scan(self, node, entry, rect):
+        ts = self.tile_size
+        x0 = (rect.left() // ts) * ts
+        y0 = (rect.top() // ts) * ts
+        x1 = (rect.right() // ts + 1) * ts
+        y1 = (rect.bottom() // ts + 1) * ts
+        w = x1 - x0
+        tiles = entry["tiles"]
+        entry["content"] = None
+        band_h = ts * max(1, OCCUPANCY_BAND_PIXELS // (w * ts))
+        for by in range(y0, y1, band_h):
+            band = QRect(x0, by, w, min(band_h, y1 - by))
+            for ty in range(band.top() // ts, (band.bottom() + 1) // ts):
+                for tx in range(x0 // ts, x1 // ts):
+                    tiles.discard((tx, ty))
+            if self.broker is not None:
+                # Las bandas del escaneo no expulsan lo que la proyección ya leyó
+                pixel_data = self.broker.read(node, band, evict=False)
+            else:
+                pixel_data = node.pixelData(band.x(), band.y(), band.width(), band.height())
+            found = self._occupied_tiles(pixel_data, band)
+            if found is None:
+                # Formato desconocido: sin índice para esta capa (se lee entera)
+                entry["scannable"] = False
+                return
+            tiles.update(found)
+
+    def _occupied_tiles(self, pixel_data, rect):
+        # Tiles (tx, ty) con algún alfa != 0 entre los píxeles de rect; rect
+        # no tiene por qué estar alineado a la rejilla. None si el formato no se conoce.
+        ts = self.tile_size
+        w, h = rect.width(), rect.height()
+        if not pixel_data or w <= 0 or h <= 0: return set()
+        bpp = len(pixel_data) // (w * h)
+        if bpp not in (4, 8) or len(pixel_data) != w * h * bpp: return None
+        tx0, ty0 = rect.x() // ts, rect.y() // ts
+        px, py = rect.x() - tx0 * ts, rect.y() - ty0 * ts
+        cols, rows = -(-(px + w) // ts), -(-(py + h) // ts)
+        if np is not None:
+            if bpp == 4:
+                alpha = np.frombuffer(pixel_data, dtype=np.uint8).reshape(h, w, 4)[:, :, 3]
+            else:
+                alpha = np.frombuffer(pixel_data, dtype='<u2').reshape(h, w, 4)[:, :, 3]
+            row_starts = [0] + [r * ts - py for r in range(1, rows)]
+            col_starts = [0] + [c * ts - px for c in range(1, cols)]
+            grid = np.logical_or.reduceat(np.logical_or.reduceat(alpha != 0, row_starts, axis=0),
+                                          col_starts, axis=1)
+            ys, xs = np.nonzero(grid)
+            return {(tx0 + x, ty0 + y) for x, y in zip(xs.tolist(), ys.tolist())}
+        # Sin numpy: bytes.count recorre cada tramo de fila en C
+        if bpp == 4:
+            alpha = bytes(pixel_data[3::4])
+        else:
+            alpha = bytes(a | b for a, b in zip(pixel_data[6::8], pixel_data[7::8]))
+        found = set()
+        for row in range(rows):
+            pending = {col: (max(0, col * ts - px), min(w, (col + 1) * ts - px)) for col in range(cols)}
+            for y in range(max(0, row * ts - py), min(h, (row + 1) * ts - py)):
+                line = y * w
+                for col, (xs, xe) in list(pending.items()):
+                    if alpha.count(0, line + xs, line + xe) != xe - xs:
+                        del pending[col]
+                        found.add((tx0 + col, ty0 + row))
+                if not pending: break
+        return found
+
+# =========================================================================================
+# LECTURAS DE PÍXELES AGRUPADAS
+# =========================================================================================
+def merge_rects(rects, waste=PIXEL_MERGE_WASTE):
+    # Funde los rects que se solapan o se tocan mientras el rect unión no
+    # añada más de 'waste' de área a la que cubrían. Devuelve [rect unión, área, índices].
+    groups = []
+    for index, rect in sorted(enumerate(rects), key=lambda item: (item[1].y(), item[1].x())):
+        area = rect.width() * rect.height()
+        grown = rect.adjusted(-1, -1, 1, 1)
+        for group in groups:
+            if not grown.intersects(group[0]): continue
+            union = group[0].united(rect)
+            if union.width() * union.height() <= (group[1] + area) * (1.0 + waste):
+                group[0] = union
+                group[1] += area
+                group[2].append(index)
+                break
+        else:
+            groups.append([QRect(rect), area, [index]])
+    return groups
+
+def disjoint_regions(rects, waste=PIXEL_MERGE_WASTE):
+    # merge_rects y después se funden las regiones que aún se solapan: un
+    # grupo puede crecer por encima de un rect que quedó en otro. Para
+    # componer, ningún píxel puede llegar en dos trozos.
+    regions = [group[0] for group in merge_rects(rects, waste)]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(i + 1, len(regions)):
+                if regions[i].intersects(regions[j]):
+                    regions[i] = regions[i].united(regions.pop(j))
+                    merged = True
+                    break
+            if merged: break
+    return regions
+
+def pixel_view(region, data, rect):
+    # Bytes de rect dentro de los de region: el mismo objeto, un memoryview
+    # si son filas completas, o las filas recortadas si no.
+    if rect == region: return data
+    bpp = len(data) // (region.width() * region.height())
+    bpl = region.width() * bpp
+    view = memoryview(data)
+    start = (rect.y() - region.y()) * bpl + (rect.x() - region.x()) * bpp
+    if rect.x() == region.x() and rect.width() == region.width():
+        return view[start:start + rect.height() * bpl]
+    row = rect.width() * bpp
+    return b"".join(view[start + i * bpl:start + i * bpl + row] for i in range(rect.height()))
+
+class PixelReadBroker:
+    # Todas las lecturas de pixelData de un tick del bucle de eventos pasan
+    # por aquí: por capa, los rects que se solapan o se tocan se leen con una
+    # sola llamada, y lo leído se guarda hasta el final del tick para servir
+    # vistas a quien pida un rect ya cubierto (escaneo de ocupación y
+    # proyección, preview y prefetch...). Con bypass activo (relecturas que
+    # fuerza el prefetcher mientras Krita pinta) no se sirve nada guardado.
+    def __init__(self, budget=PIXEL_BROKER_BUDGET_BYTES):
+        self.budget = budget
+        self.regions = OrderedDict()
+        self.used = 0
+        self.bypass = False
+        self.tick_armed = False
+        self.requests = 0
+        self.calls = 0
+        self.bytes_read = 0
+
+    def read(self, node, rect, evict=True):
+        return self.read_many(node, [rect], evict=evict)[0][1]
+
+    def read_many(self, node, rects, merged=False, evict=True):
+        # [(rect, datos)] que cubren rects. Con merged=True se devuelven
+        # regiones fundidas que no se solapan (para componer) en vez de rects.
+        # evict=False: lo leído solo se guarda si cabe sin expulsar nada.
+        self._arm_tick()
+        self.requests += len(rects)
+        layer = node_key(node)
+        rects = [QRect(r) for r in rects if not r.isEmpty()]
+        if merged:
+            # Una región en parte guardada se vuelve a leer entera: así lo
+            # guardado nunca se devuelve junto a una región que lo cubra
+            result = []
+            for region in disjoint_regions(rects):
+                cached = None if self.bypass else self._lookup(layer, region)
+                if cached is None:
+                    cached = self._read(node, layer, region, evict)
+                result.append((region, cached))
+            return result
+        result = []
+        missing = []
+        for rect in rects:
+            cached = None if self.bypass else self._lookup(layer, rect)
+            if cached is None: missing.append(rect)
+            else: result.append((rect, cached))
+        for region, _, members in merge_rects(missing):
+            data = self._read(node, layer, region, evict)
+            if not data:
+                result.extend((missing[i], data) for i in members)
+            else:
+                result.extend((missing[i], pixel_view(region, data, missing[i])) for i in members)
+        return result
+
+    def _read(self, node, layer, region, evict):
+        data = node.pixelData(region.x(), region.y(), region.width(), region.height())
+        if data is not None and not isinstance(data, bytes):
+            data = bytes(data)
+        self.calls += 1
+        self.bytes_read += len(data) if data else 0
+        if data:
+            self._store(layer, region, data, evict)
+        return data
+
+    def _lookup(self, layer, rect):
+        # Vista si una región ya leída contiene rect; si lo cubren varias (p.ej.
+        # las bandas del escaneo de ocupación) se copian sus filas.
+        pieces = []
+        covered = QRegion()
+        for key, cached in list(self.regions.items()):
+            if key[0] != layer or not cached[0].intersects(rect): continue
+            self.regions.move_to_end(key)
+            if cached[0].contains(rect):
+                return pixel_view(cached[0], cached[1], rect)
+            pieces.append(cached)
+            covered = covered.united(cached[0])
+        if not pieces or not QRegion(rect).subtracted(covered).isEmpty(): return None
+        bpp = len(pieces[0][1]) // (pieces[0][0].width() * pieces[0][0].height())
+        out = bytearray(rect.width() * rect.height() * bpp)
+        out_bpl = rect.width() * bpp
+        for region, data in pieces:
+            part = region.intersected(rect)
+            view = memoryview(data)
+            bpl = region.width() * bpp
+            n = part.width() * bpp
+            for y in range(part.top(), part.bottom() + 1):
+                src = (y - region.y()) * bpl + (part.x() - region.x()) * bpp
+                dst = (y - rect.y()) * out_bpl + (part.x() - rect.x()) * bpp
+                out[dst:dst + n] = view[src:src + n]
+        return bytes(out)
+
+    def _store(self, layer, region, data, evict=True):
+        if len(data) > self.budget: return
+        if not evict and self.used + len(data) > self.budget: return
+        if self.bypass:
+            # Lo guardado antes que se solape con esta lectura ya no vale
+            for key in [k for k, cached in self.regions.items()
+                        if k[0] == layer and cached[0].intersects(region)]:
+                self.used -= len(self.regions.pop(key)[1])
+        key = (layer, region.x(), region.y(), region.width(), region.height())
+        old = self.regions.pop(key, None)
+        if old is not None: self.used -= len(old[1])
+        self.regions[key] = (QRect(region), data)
+        self.used += len(data)
+        while self.used > self.budget:
+            _, old = self.regions.popitem(last=False)
+            self.used -= len(old[1])
+
+    def _arm_tick(self):
+        if not self.tick_armed:
+            self.tick_armed = True
+            QTimer.singleShot(0, self.end_tick)
+
+    def end_tick(self):
+        # Krita sigue pintando entre ticks: lo leído caduca aquí
+        self.tick_armed = False
+        self.regions.clear()
+        self.used = 0
+
+    def stats(self):
+        return {"pixel_requests": self.requests, "pixel_calls": self.calls,
+                "pixel_mb_read": self.bytes_read / 1048576.0}
+
+# =========================================================================================
+# COMPOSICIÓN EN PARALELO
+# =========================================================================================
+class ProjectionCompositor:
+    # Compone las capas leídas sobre la imagen final. Con imágenes grandes la
+    # divide en franjas horizontales (QImage sobre la misma memoria, sin copias)
+    # y cada hilo del pool pinta su franja; QPainter suelta el GIL.
+    # Las lecturas de Krita (pixelData) siguen en el hilo principal y se
+    # solapan con la composición de la capa anterior.
+    def __init__(self, workers=0):
+        self.pool = None
+        self.workers = 1
+        self.set_workers(workers)
+
+    def set_workers(self, workers):
+        # workers <= 0: uno por núcleo
+        count = workers if workers and workers > 0 else (os.cpu_count() or 1)
+        if count == self.workers and (self.pool is not None) == (count > 1): return
+        self.shutdown()
+        self.workers = count
+        if count > 1:
+            self.pool = ThreadPoolExecutor(max_workers=count, thread_name_prefix="infinite_canvas")
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+    def compose(self, image, view_rect, layers):
+        # layers: iterable de (opacidad, modo, [(rect, pixel_data), ...]) en orden de pintado
+        if self.pool is None or image.width() * image.height() < PARALLEL_MIN_PIXELS:
+            for layer in layers:
+                self._compose_strip(image, 0, view_rect, layer)
+            return image
+        strips = self._make_strips(image)
+        pending = []
+        for layer in layers:
+            # La franja s de la capa L no puede empezar antes que la de L-1
+            for future in pending: future.result()
+            pending = [self.pool.submit(self._compose_strip, strip, y0, view_rect, layer)
+                       for strip, y0 in strips]
+        for future in pending: future.result()
+        return image
+
+    def _make_strips(self, image):
+        h = image.height()
+        bpl = image.bytesPerLine()
+        strip_h = max(PARALLEL_MIN_STRIP, -(-h // (self.workers * 4)))
+        address = int(image.bits())
+        strips = []
+        for y0 in range(0, h, strip_h):
+            rows = min(strip_h, h - y0)
+            strip = QImage(sip.voidptr(address + y0 * bpl), image.width(), rows, bpl, image.format())
+            strips.append((strip, y0))
+        return strips
+
+    @staticmethod
+    def _compose_strip(strip, y0, view_rect, layer):
+        opacity, comp_mode, chunks = layer
+        y1 = y0 + strip.height()
+        painter = None
+        for rect, pixel_data in chunks:
+            rw, rh = rect.width(), rect.height()
+            top = rect.y() - view_rect.y()
+            r0 = max(top, y0) - top
+            r1 = min(top + rh, y1) - top
+            if r1 <= r0 or not pixel_data: continue
+            if r0 == 0 and r1 == rh:
+                rows_data = pixel_data
+            else:
+                bpp = len(pixel_data) // (rw * rh)
+                rows_data = pixel_data[r0 * rw * bpp:r1 * rw * bpp]
+            layer_img = decode_layer_pixels(rows_data, rw, r1 - r0)
+            if not layer_img: continue
+            if painter is None:
+                painter = QPainter(strip)
+                painter.setRenderHint(QPainter.Antialiasing, False)
+                painter.setRenderHint(QPainter.SmoothPixmapTransform, False)
+                painter.setOpacity(opacity)
+                painter.setCompositionMode(comp_mode)
+            painter.drawImage(rect.x() - view_rect.x(), top + r0 - y0, layer_img)
+        if painter is not None:
+            painter.end()
+
+# =========================================================================================
+# PREFETCH DE PARCHES
+# =========================================================================================
+class PatchPrefetcher:
+    # Caché pequeña de tiles alrededor del cursor (en hover) y por delante
+    # del trazo según su velocidad. process_draw compone el parche con los
+    # tiles ya leídos y solo vuelve a leer los que el pincel pudo cambiar:
+    # los cercanos al recorrido reciente (Krita pinta de forma asíncrona).
+    def __init__(self, interceptor, tile_size=PREFETCH_TILE_SIZE, max_tiles=PREFETCH_MAX_TILES):
+        self.interceptor = interceptor
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+        self.source_key = None
+        self.path = deque()
+        self.brush_radius = 0.0
+        self.pending_rect = None
+        self.suspended_until = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.tiles.clear()
+        self.pending_rect = None
+
+    def begin_stroke(self, brush_radius):
+        self.path.clear()
+        self.brush_radius = brush_radius
+
+    def end_stroke(self, now):
+        # Lo recién pintado aún puede estar llegando: nada de prefetch un momento
+        self.path.clear()
+        self.clear()
+        self.suspended_until = now + PREFETCH_SETTLE_S
+
+    def _check_source(self, doc):
+        mode = self.interceptor.source_mode
+        node = doc.activeNode() if mode == 0 else doc.rootNode()
+        if node is None: return False
+        key = (mode, node_key(node))
+        if key != self.source_key:
+            self.source_key = key
+            self.tiles.clear()
+        return True
+
+    def note_sample(self, center, now):
+        # Invalida los tiles a menos del radio del pincel del recorrido de los
+        # últimos PREFETCH_SETTLE_S. El primer toque aún no ha pintado nada
+        # (el filtro ve el evento antes que Krita).
+        self.path.append((center, now))
+        while len(self.path) > 1 and now - self.path[0][1] > PREFETCH_SETTLE_S:
+            self.path.popleft()
+        points = [p for p, _ in self.path]
+        radius = self.brush_radius
+        for a, b in zip(points, points[1:]):
+            box = QRectF(a, b).normalized().adjusted(-radius, -radius, radius, radius).toAlignedRect()
+            for key in self._tile_keys(box):
+                self.tiles.pop(key, None)
+
+    def velocity(self):
+        if len(self.path) < 2: return QPointF(0.0, 0.0)
+        (p0, t0), (p1, t1) = self.path[-2], self.path[-1]
+        dt = t1 - t0
+        if dt <= 0: return QPointF(0.0, 0.0)
+        return (p1 - p0) / dt
+
+    def request(self, rect, now):
+        # Prefetch diferido hasta que el bucle de eventos quede libre
+        if now < self.suspended_until: return
+        schedule = self.pending_rect is None
+        self.pending_rect = QRect(rect)
+        if schedule:
+            QTimer.singleShot(0, self._run_pending)
+
+    def _run_pending(self):
+        rect = self.pending_rect
+        self.pending_rect = None
+        if rect is None: return
+        doc = self.interceptor.app_ref.activeDocument()
+        if not doc or not self._check_source(doc): return
+        self._ensure(doc, rect, count=False)
+
+    def fetch(self, doc, rect):
+        if not self._check_source(doc): return None
+        self._ensure(doc, rect)
+        patch = QImage(rect.width(), rect.height(), QImage.Format_ARGB32_Premultiplied)
+        patch.fill(Qt.transparent)
+        painter = QPainter(patch)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        ts = self.tile_size
+        for key in self._tile_keys(rect):
+            tile = self.tiles.get(key)
+            if tile is not None:
+                painter.drawImage(key[0] * ts - rect.x(), key[1] * ts - rect.y(), tile)
+        painter.end()
+        return patch
+
+    def _ensure(self, doc, rect, count=True):
+        ts = self.tile_size
+        keys = self._tile_keys(rect)
+        missing = [key for key in keys if key not in self.tiles]
+        if count:
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        for key in keys:
+            if key in self.tiles: self.tiles.move_to_end(key)
+        # Tramos de tiles que faltan fundidos en regiones: una lectura por región
+        runs = [QRect(tx_start * ts, ty * ts, (tx_end - tx_start) * ts, ts)
+                for ty, tx_start, tx_end in tile_row_runs(missing)]
+        missing = set(missing)
+        broker = self.interceptor.broker
+        for region, _, _ in merge_rects(runs, waste=0.0):
+            # Durante el trazo lo que falta son tiles que el pincel pudo cambiar:
+            # Krita sigue pintando en sus hilos, así que nada de lo leído en este tick
+            broker.bypass = count
+            try:
+                image = self.interceptor.read_patch(doc, region)
+            finally:
+                broker.bypass = False
+            for key in self._tile_keys(region):
+                if key not in missing: continue
+                if image is None:
+                    tile = QImage(ts, ts, QImage.Format_ARGB32_Premultiplied)
+                    tile.fill(Qt.transparent)
+                else:
+                    tile = image.copy(key[0] * ts - region.x(), key[1] * ts - region.y(), ts, ts)
+                self.tiles[key] = tile
+        while len(self.tiles) > max(self.max_tiles, len(keys)):
+            self.tiles.popitem(last=False)
+
+    def _tile_keys(self, rect):
+        if rect.isEmpty(): return []
+        ts = self.tile_size
+        return [(tx, ty) for ty in range(rect.top() // ts, rect.bottom() // ts + 1)
+                         for tx in range(rect.left() // ts, rect.right() // ts + 1)]
+
+# =========================================================================================
+# TIER FRÍO COMPRIMIDO
+# =========================================================================================
+def pack_tile(data, pixel_size=4):
+    # Vía rápida para tiles totalmente transparentes o de un solo color
+    if data.count(0) == len(data):
+        return ("T", None, len(data))
+    head = data[:pixel_size]
+    if data == head * (len(data) // pixel_size):
+        return ("S", head, len(data))
+    return ("Z", zlib.compress(data, COLD_TIER_ZLIB_LEVEL), len(data))
+
+def unpack_tile(packed):
+    kind, payload, size = packed
+    if kind == "T": return bytes(size)
+    if kind == "S": return payload * (size // len(payload))
+    return zlib.decompress(payload)
+
+def packed_size(packed):
+    return 32 + (len(packed[1]) if packed[1] is not None else 0)
+
+class ColdTileStore:
+    # Segundo nivel de las cachés: lo que sale del LRU en crudo se guarda
+    # comprimido y se descomprime al volver a necesitarse. put() devuelve
+    # las claves expulsadas por el presupuesto para que el dueño las olvide.
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.used = 0
+        self.raw = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def put(self, key, data, pixel_size=4):
+        self.discard(key)
+        packed = pack_tile(data, pixel_size)
+        self.entries[key] = packed
+        self.used += packed_size(packed)
+        self.raw += packed[2]
+        evicted = []
+        while self.used > self.budget and self.entries:
+            old_key = next(iter(self.entries))
+            self.discard(old_key)
+            evicted.append(old_key)
+        return evicted
+
+    def take_packed(self, key):
+        packed = self.entries.pop(key, None)
+        if packed is not None:
+            self.used -= packed_size(packed)
+            self.raw -= packed[2]
+        return packed
+
+    def take(self, key):
+        packed = self.take_packed(key)
+        return unpack_tile(packed) if packed is not None else None
+
+    def discard(self, key):
+        self.take_packed(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.used = 0
+        self.raw = 0
+
+    def stats(self, prefix):
+        return {f"{prefix}_cold_tiles": len(self.entries), f"{prefix}_cold_mb": self.used / 1048576.0,
+                f"{prefix}_cold_raw_mb": self.raw / 1048576.0}
+
+# =========================================================================================
+# CACHÉ DE CAPAS RASTERIZADAS (vector, relleno, archivo, clon)
+# =========================================================================================
+class RasterLayerCache:
+    # Krita rasteriza o resuelve estas capas en cada pixelData. Se guardan sus
+    # tiles ya leídos por uuid de capa; si cambia la revisión (propiedades de
+    # la capa o ediciones vistas por el plugin) se descartan todos sus tiles.
+    # LRU global con presupuesto en bytes; lo que sale de él pasa al tier frío.
+    def __init__(self, tile_size=RASTER_CACHE_TILE_SIZE, budget=RASTER_CACHE_BUDGET_BYTES,
+                 cold_budget=RASTER_COLD_BUDGET_BYTES, broker=None):
+        self.tile_size = tile_size
+        self.broker = broker
+        self.budget = budget
+        self.tiles = OrderedDict()
+        self.cold = ColdTileStore(cold_budget)
+        self.layer_tiles = {}
+        self.layer_revisions = {}
+        self.edits = {}
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def handles(node):
+        return node.type() in RASTERIZED_LAYER_TYPES
+
+    def note_edit(self, node):
+        key = node_key(node)
+        self.edits[key] = self.edits.get(key, 0) + 1
+
+    def revision(self, node, frame=0):
+        b = node.bounds()
+        rev = [node.type(), b.x(), b.y(), b.width(), b.height(), self.edits.get(node_key(node), 0)]
+        if node_animated(node): rev.append(frame)
+        try:
+            kind = node.type()
+            if kind == "filelayer":
+                path = node.path()
+                rev += [path, os.path.getmtime(path) if os.path.exists(path) else None, node.scalingMethod()]
+            elif kind == "filllayer":
+                config = node.filterConfig()
+                props = config.properties() if config else {}
+                rev += [node.generatorName(), tuple(sorted((k, str(v)) for k, v in props.items()))]
+            elif kind == "clonelayer":
+                source = node.sourceNode()
+                if source is not None:
+                    rev.append(tuple(self.revision(source, frame)))
+        except (AttributeError, OSError):
+            pass
+        return tuple(rev)
+
+    def chunks(self, node, rects, frame=0):
+        # Trozos (rect del tile, pixel_data) que cubren rects; lo que falta se
+        # lee con un pixelData por tramo horizontal de tiles contiguos
+        layer = node_key(node)
+        revision = self.revision(node, frame)
+        if self.layer_revisions.get(layer) != revision:
+            self.drop_layer(layer)
+            self.layer_revisions[layer] = revision
+        ts = self.tile_size
+        wanted = []
+        seen = set()
+        for rect in rects:
+            for ty in range(rect.top() // ts, rect.bottom() // ts + 1):
+                for tx in range(rect.left() // ts, rect.right() // ts + 1):
+                    if (tx, ty) not in seen:
+                        seen.add((tx, ty))
+                        wanted.append((tx, ty))
+        # found: lo de esta llamada, aunque el LRU lo haya vuelto a expulsar
+        found = {}
+        missing = []
+        for tx, ty in wanted:
+            key = (layer, tx, ty)
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                found[key] = self.tiles[key]
+            elif key in self.cold:
+                found[key] = self.cold.take(key)
+                self._store(key, found[key])
+            else:
+                missing.append((tx, ty))
+        self.hits += len(wanted) - len(missing)
+        self.misses += len(missing)
+        runs = [QRect(tx0 * ts, ty * ts, (tx1 - tx0) * ts, ts) for ty, tx0, tx1 in tile_row_runs(missing)]
+        if self.broker is not None:
+            reads = self.broker.read_many(node, runs)
+        else:
+            reads = [(run, node.pixelData(run.x(), run.y(), run.width(), run.height())) for run in runs]
+        for run, data in reads:
+            if not data: continue
+            ty, tx0 = run.y() // ts, run.x() // ts
+            tx1 = tx0 + run.width() // ts
+            bpl = len(data) // ts
+            tile_bpl = bpl // (tx1 - tx0)
+            for tx in range(tx0, tx1):
+                off = (tx - tx0) * tile_bpl
+                key = (layer, tx, ty)
+                found[key] = b"".join(data[row * bpl + off:row * bpl + off + tile_bpl] for row in range(ts))
+                self._store(key, found[key])
+        return [(QRect(key[1] * ts, key[2] * ts, ts, ts), data) for key, data in found.items()]
+
+    def _store(self, key, data):
+        self.tiles[key] = data
+        self.layer_tiles.setdefault(key[0], set()).add(key)
+        self.used += len(data)
+        while self.used > self.budget and len(self.tiles) > 1:
+            old_key, old = self.tiles.popitem(last=False)
+            self.used -= len(old)
+            bpp = max(1, len(old) // (self.tile_size * self.tile_size))
+            for evicted in self.cold.put(old_key, old, bpp):
+                self.layer_tiles.get(evicted[0], set()).discard(evicted)
+
+    def drop_layer(self, layer):
+        for key in self.layer_tiles.pop(layer, ()):
+            data = self.tiles.pop(key, None)
+            if data is not None: self.used -= len(data)
+            else: self.cold.discard(key)
+        self.layer_revisions.pop(layer, None)
+
+    def clear(self):
+        self.tiles.clear()
+        self.cold.clear()
+        self.layer_tiles.clear()
+        self.layer_revisions.clear()
+        self.used = 0
+
+    def stats(self):
+        data = {"raster_cache_mb": self.used / 1048576.0,
+                "raster_cache_hit_tiles": self.hits, "raster_cache_miss_tiles": self.misses}
+        data.update(self.cold.stats("raster_cache"))
+        return data
+
+# =========================================================================================
+# CACHÉ POR FOTOGRAMA (documentos animados)
+# =========================================================================================
+def document_frame(doc):
+    try: return doc.currentTime()
+    except AttributeError: return 0
+
+def node_animated(node):
+    try: return node.animated()
+    except AttributeError: return False
+
+def layer_signature(node):
+    # Propiedades del árbol que cambian la composición sin pasar por un trazo
+    return tuple((node_key(child), child.visible(), child.opacity(), child.blendingMode(),
+                  layer_signature(child)) for child in node.childNodes())
+
+def tree_animated(node):
+    return any(node_animated(child) or tree_animated(child) for child in node.childNodes())
+
+def same_keyframe(node, frame_a, frame_b):
+    # ¿Ambos fotogramas muestran el mismo fotograma clave de la capa?
+    if frame_a == frame_b or not node_animated(node): return True
+    lo, hi = min(frame_a, frame_b), max(frame_a, frame_b)
+    return not any(node.hasKeyframeAtTime(t) for t in range(lo + 1, hi + 1))
+
+class FrameProjectionCache:
+    # Imagen base (pixmap ya escalado) y rectángulo de origen por
+    # (documento, fotograma, modo, capa o propiedades del árbol). Solo al
+    # cambiar de fotograma se reutiliza lo ya proyectado; los refrescos
+    # forzados vuelven a proyectar. Una edición solo invalida los fotogramas que muestran
+    # el mismo fotograma clave de la capa editada. LRU con presupuesto en bytes;
+    # los fotogramas que salen de él pasan troceados al tier frío.
+    def __init__(self, budget=FRAME_CACHE_BUDGET_BYTES, cold_budget=FRAME_COLD_BUDGET_BYTES):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.cold = ColdTileStore(cold_budget)
+        self.cold_frames = {}
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(doc, frame, mode):
+        if mode != 0:
+            root = doc.rootNode()
+            return (node_key(root), frame, mode, layer_signature(root))
+        # Una capa sin animar se ve igual en todos los fotogramas
+        node = doc.activeNode()
+        if node is None: return None
+        return (node_key(doc.rootNode()), frame if node_animated(node) else None, mode, node_key(node))
+
+    def get(self, key, src_rect=None):
+        if key not in self.entries and key in self.cold_frames:
+            if src_rect is not None and self.cold_frames[key][0] != src_rect:
+                self._drop(key)
+            else:
+                self._thaw(key)
+        entry = self.entries.get(key)
+        if entry is not None and src_rect is not None and entry[0] != src_rect:
+            self._drop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, src_rect, pixmap):
+        self._drop(key)
+        if key[2] != 0:
+            # Con otras propiedades del árbol un cambio de fotograma ya no llega a esas claves
+            for old in [k for k in list(self.entries) + list(self.cold_frames)
+                        if k[0] == key[0] and k[2] == key[2] and k[3] != key[3]]:
+                self._drop(old)
+        size = pixmap.width() * pixmap.height() * 4
+        if size > self.budget: return
+        self.entries[key] = (QRect(src_rect), pixmap, size)
+        self.used += size
+        while self.used > self.budget:
+            self._freeze(next(iter(self.entries)))
+
+    def _freeze(self, key):
+        src_rect, pixmap, size = self.entries.pop(key)
+        self.used -= size
+        image = pixmap.toImage().convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        w, h = image.width(), image.height()
+        ts = COLD_TILE_SIZE
+        tiles = [QRect(x, y, min(ts, w - x), min(ts, h - y)) for y in range(0, h, ts) for x in range(0, w, ts)]
+        self.cold_frames[key] = (src_rect, w, h, tiles)
+        for index, rect in enumerate(tiles):
+            tile = image.copy(rect)
+            for evicted in self.cold.put((key, index), tile.constBits().asstring(tile.sizeInBytes())):
+                self._drop_cold(evicted[0])
+            if key not in self.cold_frames: return
+
+    def _thaw(self, key):
+        # Los tiles transparentes ni se descomprimen ni se pintan
+        src_rect, w, h, tiles = self.cold_frames.pop(key)
+        image = QImage(w, h, QImage.Format_ARGB32_Premultiplied)
+        image.fill(Qt.transparent)
+        painter = QPainter(image)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        for index, rect in enumerate(tiles):
+            packed = self.cold.take_packed((key, index))
+            if packed is None or packed[0] == "T": continue
+            tile = QImage(unpack_tile(packed), rect.width(), rect.height(), rect.width() * 4,
+                          QImage.Format_ARGB32_Premultiplied)
+            painter.drawImage(rect.topLeft(), tile)
+        painter.end()
+        self.put(key, src_rect, QPixmap.fromImage(image))
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.used -= entry[2]
+        self._drop_cold(key)
+
+    def _drop_cold(self, key):
+        frame = self.cold_frames.pop(key, None)
+        if frame is not None:
+            for index in range(len(frame[3])):
+                self.cold.discard((key, index))
+
+    def invalidate_edit(self, doc, node, frame):
+        # node se editó en frame: caen las proyecciones Full Document y las de
+        # esa capa cuyos fotogramas comparten fotograma clave con frame
+        doc_key = node_key(doc.rootNode())
+        layer_key = node_key(node)
+        for key in list(self.entries) + list(self.cold_frames):
+            if key[0] != doc_key: continue
+            if key[2] == 0 and key[3] != layer_key: continue
+            if key[1] is None or same_keyframe(node, frame, key[1]):
+                self._drop(key)
+
+    def clear(self, doc=None):
+        if doc is None:
+            self.entries.clear()
+            self.cold.clear()
+            self.cold_frames.clear()
+            self.used = 0
+            return
+        doc_key = node_key(doc.rootNode())
+        for key in [k for k in list(self.entries) + list(self.cold_frames) if k[0] == doc_key]:
+            self._drop(key)
+
+    def stats(self):
+        data = {"frame_cache_entries": len(self.entries), "frame_cache_mb": self.used / 1048576.0,
+                "frame_cache_cold_frames": len(self.cold_frames),
+                "frame_cache_hits": self.hits, "frame_cache_misses": self.misses}
+        data.update(self.cold.stats("frame_cache"))
+        return data
+
+# =========================================================================================
+# TEMPORIZADORES CON BACKOFF EN REPOSO
+# =========================================================================================
+class ActivityScheduler(QObject):
+    # Los bucles de sondeo (sync del overlay, monitor de bounds) van a su
+    # ritmo base mientras hay actividad; tras IDLE_BACKOFF_AFTER_S sin entrada
+    # ni cambios de vista su intervalo se duplica en cada tick hasta su
+    # máximo, y el primer evento lo devuelve al ritmo base. La entrada llega
+    # desde el filtro del InputInterceptor o, con el seguimiento apagado, de
+    # un filtro sobre el viewport del canvas: nunca de un filtro global más.
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.loops = {}
+        self.last_activity = time.monotonic()
+        self.backed_off = False
+        self.watched = None
+        self.wakeups = deque()
+        self.total_wakeups = 0
+
+    def add_loop(self, name, timer, base_ms, max_ms):
+        timer.setInterval(base_ms)
+        timer.timeout.connect(lambda: self._on_tick(name))
+        self.loops[name] = {"timer": timer, "base": base_ms, "max": max_ms}
+
+    def start(self, name):
+        loop = self.loops[name]
+        loop["timer"].start(loop["base"])
+
+    def stop(self, name):
+        self.loops[name]["timer"].stop()
+
+    def watch(self, widget):
+        if self.watched is not None:
+            try: self.watched.removeEventFilter(self)
+            except RuntimeError: pass
+        self.watched = widget
+        if widget is not None:
+            widget.installEventFilter(self)
+
+    def is_idle(self):
+        return time.monotonic() - self.last_activity > IDLE_BACKOFF_AFTER_S
+
+    def note_activity(self):
+        self.last_activity = time.monotonic()
+        if not self.backed_off: return
+        self.backed_off = False
+        for loop in self.loops.values():
+            timer = loop["timer"]
+            if timer.isActive() and timer.interval() != loop["base"]:
+                timer.start(loop["base"])
+
+    def _on_tick(self, name):
+        now = time.monotonic()
+        self.total_wakeups += 1
+        self.wakeups.append(now)
+        while self.wakeups and now - self.wakeups[0] > IDLE_STATS_WINDOW_S:
+            self.wakeups.popleft()
+        if now - self.last_activity > IDLE_BACKOFF_AFTER_S:
+            loop = self.loops[name]
+            timer = loop["timer"]
+            interval = min(loop["max"], timer.interval() * 2)
+            if interval != timer.interval():
+                timer.setInterval(interval)
+                self.backed_off = True
+
+    def eventFilter(self, obj, event):
+        if event.type() in ACTIVITY_EVENT_TYPES:
+            self.note_activity()
+        return False
+
+    def stats(self):
+        now = time.monotonic()
+        recent = sum(1 for t in self.wakeups if now - t <= IDLE_STATS_WINDOW_S)
+        data = {
+            "wakeups_per_s": recent / IDLE_STATS_WINDOW_S,
+            "total_wakeups": self.total_wakeups,
+            "idle": self.is_idle(),
+        }
+        for name, loop in self.loops.items():
+            data[f"{name}_interval_ms"] = loop["timer"].interval() if loop["timer"].isActive() else 0
+        return data
+
+# =========================================================================================
+# EXPORTACIÓN POR BANDAS
+# =========================================================================================
+class StreamingPngWriter:
+    # PNG RGBA de 8 bits escrito banda a banda: solo hay en memoria la banda
+    # actual y lo que zlib aún no ha vaciado.
+    SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+    def __init__(self, path, width, height):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.file = open(path, 'wb')
+        self.compressor = zlib.compressobj(EXPORT_PNG_LEVEL)
+        self.pending = bytearray()
+        self.file.write(self.SIGNATURE)
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+
+    def _chunk(self, tag, data):
+        self.file.write(struct.pack(">I", len(data)) + tag)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF))
+
+    def _emit(self, data, final=False):
+        self.pending += data
+        if len(self.pending) >= EXPORT_IDAT_SIZE or (final and self.pending):
+            self._chunk(b"IDAT", bytes(self.pending))
+            self.pending = bytearray()
+
+    def write_rows(self, image):
+        # image: banda de self.width de ancho, cualquier formato
+        rgba = image.convertToFormat(QImage.Format_RGBA8888)
+        bpl = rgba.bytesPerLine()
+        row_len = self.width * 4
+        data = memoryview(rgba.constBits().asstring(rgba.sizeInBytes()))
+        for row in range(rgba.height()):
+            start = row * bpl
+            self._emit(self.compressor.compress(b"\x00"))   # filtro None
+            self._emit(self.compressor.compress(data[start:start + row_len]))
+        self.rows_written += rgba.height()
+
+    def close(self):
+        if self.file is None: return
+        self._emit(self.compressor.flush(), final=True)
+        self._chunk(b"IEND", b"")
+        self.file.close()
+        self.file = None
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        try: os.remove(self.path)
+        except OSError: pass
+
+def export_projection(interceptor, doc, rect, path, progress=None):
+    # Vuelca 'rect' del documento a un PNG por bandas usando el proyector del
+    # interceptor (capa activa o Full Document según su modo). progress(hechas,
+    # total) puede devolver False para cancelar. Devuelve True si terminó.
+    width, height = rect.width(), rect.height()
+    band_h = max(1, min(height, EXPORT_BAND_PIXELS // max(1, width)))
+    writer = StreamingPngWriter(path, width, height)
+    try:
+        for y in range(rect.y(), rect.y() + height, band_h):
+            rows = min(band_h, rect.y() + height - y)
+            band = interceptor.read_patch(doc, QRect(rect.x(), y, width, rows))
+            if band is None:
+                band = QImage(width, rows, QImage.Format_ARGB32_Premultiplied)
+                band.fill(Qt.transparent)
+            writer.write_rows(band)
+            # Las bandas no se solapan: no tiene sentido retener lo leído
+            interceptor.broker.end_tick()
+            if progress is not None and progress(writer.rows_written, height) is False:
+                writer.abort()
+                return False
+        writer.close()
+        return True
+    except Exception:
+        writer.abort()
+        raise
+
 # =========================================================================================
 # CLASE 1: OVERLAY
 # =========================================================================================
 class OverlayWidget(QWidget):
-    def __init__(self, docker_ref, parent=None):
+    def __init__(self, docker_ref, parent=None, scheduler=None):
         super().__init__(parent)
         self.docker = docker_ref
+        self.scheduler = scheduler
         self.setWindowFlags(Qt.FramelessWindowHint)
         self.setAttribute(Qt.WA_TranslucentBackground)
         self.setAttribute(Qt.WA_NoSystemBackground)
         self.setAttribute(Qt.WA_DeleteOnClose)
         self.setAttribute(Qt.WA_TransparentForMouseEvents, True)
         self.setFocusPolicy(Qt.NoFocus)
-        self.live_stroke_buffer = None
-        self.buffer_transform = QTransform()
-        self.has_content = False
+        # Trazo en vivo en coordenadas de documento (× live_scale): sobrevive a
+        # pan, zoom y rotación y se reproyecta con la vista actual al pintar.
+        self.live_stroke_buffer = SparseTileBuffer()
+        self.live_scale = 1.0
+        self.view_transform = None
+        # Con opacidad < 1 la zona dañada se compone aquí y se vuelca de una vez
         self.render_buffer = None
         self.global_opacity = 1.0
         self.crop_enabled = False
@@ -64,42 +1438,49 @@ class OverlayWidget(QWidget):
         self.overlay_color = color
         self.no_color_enabled = no_color
         self.source_mode = mode
-        self.update()
+        schedule_update(self)
 
     def ensure_buffers(self):
+        if self.global_opacity >= 1.0:
+            self.render_buffer = None
+            return
         size = self.size()
-        if self.live_stroke_buffer is None or self.live_stroke_buffer.size() != size:
-            self.live_stroke_buffer = QPixmap(size)
-            self.live_stroke_buffer.fill(Qt.transparent)
-            self.has_content = False   
         if self.render_buffer is None or self.render_buffer.size() != size:
             self.render_buffer = QPixmap(size)
 
     def clear_live_buffer(self):
-        if self.live_stroke_buffer and self.has_content:
-            self.live_stroke_buffer.fill(Qt.transparent)
-            self.has_content = False
-            self.update()
+        if not self.live_stroke_buffer.is_empty():
+            damage = None
+            if self.view_transform is not None:
+                to_screen = self.live_to_screen(self.view_transform)
+                damage = to_screen.mapRect(QRectF(self.live_stroke_buffer.bounds())).toAlignedRect().adjusted(-1, -1, 1, 1)
+            self.live_stroke_buffer.clear()
+            schedule_update(self, damage)
 
     def handle_live_patch(self, image, doc_x, doc_y, doc_w, doc_h, current_transform):
-        self.ensure_buffers()
-        if current_transform != self.buffer_transform:
-            self.live_stroke_buffer.fill(Qt.transparent)
-            self.buffer_transform = current_transform
-        painter = QPainter(self.live_stroke_buffer)
-        painter.setRenderHint(QPainter.Antialiasing, False)
-        painter.setRenderHint(QPainter.SmoothPixmapTransform, False)
-        painter.setCompositionMode(QPainter.CompositionMode_Source)
-        painter.setTransform(current_transform)
-        rect_doc = QRectF(doc_x, doc_y, doc_w, doc_h).adjusted(-0.5, -0.5, 0.5, 0.5)
-        painter.drawImage(rect_doc, image)
-        painter.end()
-        self.has_content = True
-        self.update()
+        if self.live_stroke_buffer.is_empty():
+            # Resolución del trazo: la del zoom actual, nunca por debajo de la
+            # imagen base (ViewState.scale) ni por encima de 1:1 con el documento
+            zoom = abs(current_transform.determinant()) ** 0.5
+            self.live_scale = min(1.0, max(self.docker.view_state.scale, zoom))
+        s = self.live_scale
+        self.view_transform = QTransform(current_transform)
+        dirty = self.live_stroke_buffer.stamp(image, QRectF(doc_x * s, doc_y * s, doc_w * s, doc_h * s))
+        to_screen = self.live_to_screen(current_transform)
+        damage = to_screen.mapRect(QRectF(dirty))
+        # El parche también se estampó en la imagen base: el redondeo y el
+        # filtrado al escalarla lo extienden hasta dos píxeles de esa imagen
+        m = 2.0 / (self.docker.view_state.scale or 1.0)
+        damage = damage.united(current_transform.mapRect(QRectF(doc_x - m, doc_y - m, doc_w + 2 * m, doc_h + 2 * m)))
+        schedule_update(self, damage.toAlignedRect().adjusted(-1, -1, 1, 1))
+
+    def live_to_screen(self, current_transform):
+        return QTransform.fromScale(1.0 / self.live_scale, 1.0 / self.live_scale) * current_transform
 
     def paintEvent(self, event):
-        self.ensure_buffers()
-        self.render_buffer.fill(Qt.transparent)
+        # Solo se recompone la zona dañada (parches del trazo, limpiezas); los
+        # cambios de vista o de ajustes piden el widget entero.
+        damage = event.rect()
         doc = Krita.instance().activeDocument()
         view = Krita.instance().activeWindow().activeView()
         if not doc or not view: return
@@ -117,12 +1498,19 @@ class OverlayWidget(QWidget):
         sx = -scale_factor if mirror else scale_factor
         sy = scale_factor
         current_transform.scale(sx, sy)
-
-        if self.has_content:
-            if current_transform != self.buffer_transform:
-                self.clear_live_buffer()
-
-        painter = QPainter(self.render_buffer)
+        self.view_transform = current_transform
+
+        if self.global_opacity < 1.0:
+            self.ensure_buffers()
+            target = self.render_buffer
+            clear = QPainter(target)
+            clear.setCompositionMode(QPainter.CompositionMode_Source)
+            clear.fillRect(damage, Qt.transparent)
+            clear.end()
+        else:
+            target = self
+        painter = QPainter(target)
+        painter.setClipRegion(event.region())
         painter.setRenderHint(QPainter.Antialiasing)
         painter.setRenderHint(QPainter.SmoothPixmapTransform)
 
@@ -131,31 +1519,25 @@ class OverlayWidget(QWidget):
         path_doc_static_local.addRect(rect_doc_static)
         path_doc_screen = current_transform.map(path_doc_static_local)
 
+        # El hueco es el rect que proyecta el viewport (bounds ajustados al contenido)
         rect_hole = rect_doc_static 
-        if self.source_mode == 0: 
-            if doc.activeNode():
-                b = doc.activeNode().bounds()
-                if b.width() > 0:
-                    rect_hole = QRectF(b.x(), b.y(), b.width(), b.height())
-        else:
-            root = doc.rootNode()
-            if root:
-                b = root.bounds()
-                if b.width() > 0:
-                    rect_hole = QRectF(b.x(), b.y(), b.width(), b.height())
+        vs_hole = self.docker.view_state
+        if vs_hole.valid and vs_hole.src_rect.width() > 0:
+            rect_hole = QRectF(vs_hole.src_rect)
 
         path_hole_local = QPainterPath()
         path_hole_local.addRect(rect_hole)
         path_hole_screen = current_transform.map(path_hole_local)
 
         path_full_screen = QPainterPath()
-        path_full_screen.addRect(QRectF(self.rect()))
+        path_full_screen.addRect(QRectF(damage))
         
         path_blue_area = path_full_screen.subtracted(path_hole_screen)
         path_outside_canvas = path_full_screen.subtracted(path_doc_screen)
 
+        painter.save()
         if self.crop_enabled:
-            painter.setClipPath(path_outside_canvas)
+            painter.setClipPath(path_outside_canvas, Qt.IntersectClip)
 
         if not self.no_color_enabled:
             painter.setBrush(self.overlay_color) 
@@ -165,18 +1547,25 @@ class OverlayWidget(QWidget):
         vp = self.docker.main_viewport
         vs = self.docker.view_state
         if vp and vs.valid and vp.base_pixmap:
+            # El recorte a la zona dañada ya limita el muestreo a esos píxeles
             painter.save()
-            painter.setTransform(current_transform)
+            painter.setTransform(current_transform, True)
             target_rect = QRectF(vs.src_rect)
             src_rect = QRectF(vp.base_pixmap.rect())
             painter.drawPixmap(target_rect, vp.base_pixmap, src_rect)
             painter.restore()
 
-        if self.live_stroke_buffer and self.has_content:
-            painter.drawPixmap(0, 0, self.live_stroke_buffer)
+        if not self.live_stroke_buffer.is_empty():
+            to_screen = self.live_to_screen(current_transform)
+            live_inverse, live_invertible = to_screen.inverted()
+            if live_invertible:
+                painter.save()
+                painter.setTransform(to_screen, True)
+                visible = live_inverse.mapRect(QRectF(damage)).toAlignedRect()
+                self.live_stroke_buffer.draw(painter, clip_rect=visible)
+                painter.restore()
 
-        if self.crop_enabled:
-            painter.setClipping(False)
+        painter.restore()
 
         if self.outline_enabled:
             pen = QPen(Qt.black)
@@ -186,12 +1575,13 @@ class OverlayWidget(QWidget):
             painter.drawPath(path_doc_screen)
 
         painter.end()
-        final_painter = QPainter(self)
-        final_painter.setOpacity(self.global_opacity)
-        final_painter.drawPixmap(0, 0, self.render_buffer)
+        if target is not self:
+            final_painter = QPainter(self)
+            final_painter.setClipRegion(event.region())
+            final_painter.setOpacity(self.global_opacity)
+            final_painter.drawPixmap(damage, self.render_buffer, damage)
 
     def resizeEvent(self, event):
-        self.live_stroke_buffer = None
         self.render_buffer = None
         super().resizeEvent(event)
 
@@ -200,8 +1590,9 @@ class OverlayWidget(QWidget):
 # =========================================================================================
 class MainViewportWidget(QOpenGLWidget):
     contentChanged = pyqtSignal()
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, scheduler=None):
         super().__init__(parent)
+        self.scheduler = scheduler
         self.base_pixmap = None     
         self.trail_buffer = None    
         self.cursor_rect = None
@@ -222,25 +1613,25 @@ class MainViewportWidget(QOpenGLWidget):
 
     def init_buffers(self, width, height):
         if width <= 0 or height <= 0: return
-        self.trail_buffer = QPixmap(width, height)
-        self.trail_buffer.fill(Qt.transparent)
+        self.trail_buffer = SparseTileBuffer(width, height)
 
     def set_base_background(self, pixmap):
         self.base_pixmap = pixmap
         if pixmap is None:
-            self.update()
+            schedule_update(self)
             self.contentChanged.emit()
             return
         if self.trail_buffer:
             if self.trail_buffer.size() != pixmap.size():
-                self.trail_buffer = QPixmap(pixmap.size())
-            self.trail_buffer.fill(Qt.transparent)
-        self.update()
+                self.trail_buffer.resize(pixmap.width(), pixmap.height())
+            else:
+                self.trail_buffer.clear()
+        schedule_update(self)
         self.contentChanged.emit()
 
     def update_cursor_pos(self, cursor_rect):
         self.cursor_rect = cursor_rect
-        self.update()
+        schedule_update(self)
 
     def stamp_trail(self, patch_image, dest_rect, cursor_rect):
         int_rect = dest_rect.toRect()
@@ -251,18 +1642,14 @@ class MainViewportWidget(QOpenGLWidget):
             painter_base.drawImage(int_rect, patch_image)
             painter_base.end()
         if self.trail_buffer:
-            painter_trail = QPainter(self.trail_buffer)
-            painter_trail.setRenderHint(QPainter.Antialiasing, False)
-            painter_trail.setCompositionMode(QPainter.CompositionMode_Source)
-            painter_trail.drawImage(int_rect, patch_image)
-            painter_trail.end()
+            self.trail_buffer.stamp(patch_image, int_rect)
         self.cursor_rect = cursor_rect
-        self.update() 
-        self.contentChanged.emit()
+        # Sin contentChanged: el overlay repinta la zona del parche desde handle_live_patch
+        schedule_update(self)
 
     def set_reticle_visible(self, visible):
         self.show_reticle = visible
-        self.update()
+        schedule_update(self)
         self.contentChanged.emit()
 
     def paintGL(self):
@@ -286,7 +1673,7 @@ class MainViewportWidget(QOpenGLWidget):
             source_rect = self.base_pixmap.rect() 
             painter.drawPixmap(target_rect, self.base_pixmap, source_rect)
             if self.trail_buffer:
-                painter.drawPixmap(target_rect, self.trail_buffer, source_rect)
+                self.trail_buffer.draw(painter, x, y, scale)
             if self.show_reticle and self.cursor_rect:
                 painter.setRenderHint(QPainter.Antialiasing, False)
                 pen = QPen(QColor(0, 120, 255))
@@ -305,9 +1692,11 @@ class MainViewportWidget(QOpenGLWidget):
 # CLASE 3: PREVIEW
 # =========================================================================================
 class CameraPreviewWidget(QWidget):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, scheduler=None):
         super().__init__(parent)
+        self.scheduler = scheduler
         self.image = None
+        self.scaled_image = None
         self.grid_brush = self._create_grid_brush()
         self.setFixedSize(300, 300) 
     def _create_grid_brush(self):
@@ -321,12 +1710,18 @@ class CameraPreviewWidget(QWidget):
         return QBrush(pixmap)
     def update_image(self, image):
         self.image = image
-        self.repaint() 
+        self.scaled_image = None
+        schedule_update(self)
+    def resizeEvent(self, event):
+        self.scaled_image = None
+        super().resizeEvent(event)
     def paintEvent(self, event):
         painter = QPainter(self)
         painter.fillRect(self.rect(), self.grid_brush)
         if self.image and not self.image.isNull():
-            scaled_img = self.image.scaled(self.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            if self.scaled_image is None:
+                self.scaled_image = self.image.scaled(self.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            scaled_img = self.scaled_image
             x = (self.width() - scaled_img.width()) // 2
             y = (self.height() - scaled_img.height()) // 2
             painter.drawImage(x, y, scaled_img)
@@ -334,6 +1729,66 @@ class CameraPreviewWidget(QWidget):
 # =========================================================================================
 # CLASE 4: INTERCEPTOR
 # =========================================================================================
+class StrokeRecorder:
+    # Graba el flujo de eventos que ve InputInterceptor.eventFilter para
+    # reproducirlo luego sin Krita (ver headless.py).
+    MAGIC = b"ICSTRK01"
+    EVENT = struct.Struct("<cdIHffHHIf")   # t, timestamp Qt, tipo, pos global, botón, botones, modificadores, presión
+    VIEW = struct.Struct("<cd6d")          # t, transformación documento -> global
+    HEADER_LEN = struct.Struct("<I")
+
+    def __init__(self, path, header):
+        self.path = path
+        self.file = open(path, 'wb')
+        payload = json.dumps(header).encode('utf-8')
+        self.file.write(self.MAGIC + self.HEADER_LEN.pack(len(payload)) + payload)
+        self.start = time.perf_counter()
+        self.last_view = None
+        self.events = 0
+
+    def record(self, interceptor, event):
+        if self.file is None: return
+        t = time.perf_counter() - self.start
+        etype = event.type()
+        is_tablet = etype in (QEvent.TabletPress, QEvent.TabletRelease, QEvent.TabletMove)
+        pos = event.globalPosF() if is_tablet else event.screenPos()
+        view = interceptor.global_view_transform(event.globalPos())
+        if view is not None:
+            values = (view.m11(), view.m12(), view.m21(), view.m22(), view.dx(), view.dy())
+            if values != self.last_view:
+                self.last_view = values
+                self.file.write(self.VIEW.pack(b'V', t, *values))
+        modifiers, mouse_buttons = interceptor.input_state()
+        pressure = event.pressure() if is_tablet else 1.0
+        self.file.write(self.EVENT.pack(b'E', t, event.timestamp() & 0xFFFFFFFF, int(etype),
+                                        pos.x(), pos.y(), int(event.button()), int(mouse_buttons),
+                                        int(modifiers), pressure))
+        self.events += 1
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[:len(cls.MAGIC)] != cls.MAGIC:
+            raise ValueError(f"No es una grabación de trazos: {path}")
+        offset = len(cls.MAGIC)
+        (header_len,) = cls.HEADER_LEN.unpack_from(data, offset)
+        offset += cls.HEADER_LEN.size
+        header = json.loads(data[offset:offset + header_len].decode('utf-8'))
+        offset += header_len
+        records = []
+        while offset < len(data):
+            tag = data[offset:offset + 1]
+            layout = cls.EVENT if tag == b'E' else cls.VIEW
+            records.append(layout.unpack_from(data, offset))
+            offset += layout.size
+        return header, records
+
 class ViewState:
     def __init__(self):
         self.src_rect = QRect(0, 0, 100, 100) 
@@ -347,9 +1802,17 @@ class InputInterceptor(QObject):
     stroke_finished = pyqtSignal()
     live_patch_ready = pyqtSignal(QImage, float, float, float, float, QTransform) 
 
-    def __init__(self, view_state, main_viewport, camera_preview):
+    def __init__(self, view_state, main_viewport, camera_preview, occupancy=None):
         super().__init__()
         self.view_state = view_state
+        self.occupancy = occupancy
+        self.broker = PixelReadBroker()
+        if occupancy is not None and occupancy.broker is None:
+            # El escaneo de ocupación y la proyección de un mismo tick comparten lecturas
+            occupancy.broker = self.broker
+        self.compositor = ProjectionCompositor()
+        self.prefetcher = PatchPrefetcher(self)
+        self.raster_cache = RasterLayerCache(broker=self.broker)
         self.main_viewport = main_viewport
         self.camera_preview = camera_preview
         self.active = False
@@ -359,6 +1822,12 @@ class InputInterceptor(QObject):
         self.min_interval = 0.010 
         self.is_drawing = False
         self.source_mode = 0 # 0: Layer, 1: Full
+        self.recorder = None
+        self.clock = time.time
+        self.brush_size = float(BASE_CAMERA_SIZE)
+        self.brush_size_time = 0.0
+        self.last_draw_pt = None
+        self.activity = None
 
     def set_multiplier(self, mult):
         self.size_multiplier = mult
@@ -368,12 +1837,16 @@ class InputInterceptor(QObject):
     def eventFilter(self, obj, event):
         if not self.active: return False
         etype = event.type()
+        if self.activity is not None and etype in ACTIVITY_EVENT_TYPES:
+            self.activity.note_activity()
+        if self.recorder is not None and etype in INPUT_EVENT_TYPES:
+            self.recorder.record(self, event)
         
         if not self.view_state.valid: return False
         
-        modifiers = QApplication.keyboardModifiers()
+        modifiers, mouse_buttons = self.input_state()
         is_navigating = (modifiers & (Qt.ControlModifier | Qt.AltModifier)) or \
-                        (QApplication.mouseButtons() == Qt.MiddleButton)
+                        (mouse_buttons == Qt.MiddleButton)
 
         if is_navigating:
             self.is_drawing = False
@@ -382,12 +1855,16 @@ class InputInterceptor(QObject):
         if etype in [QEvent.MouseButtonPress, QEvent.TabletPress]:
             if event.button() == Qt.LeftButton:
                 self.is_drawing = True
+                self.last_draw_pt = None
+                self.refresh_brush_size()
+                self.prefetcher.begin_stroke(self.brush_size / 2.0)
                 self.process_draw(event)
             return False 
 
         if etype in [QEvent.MouseButtonRelease, QEvent.TabletRelease]:
             if self.is_drawing:
                 self.is_drawing = False
+                self.prefetcher.end_stroke(self.clock())
                 self.stroke_finished.emit()
             return False
 
@@ -400,17 +1877,47 @@ class InputInterceptor(QObject):
             
         return False
 
-    def _calculate_geometry(self, global_pos):
+    def input_state(self):
+        return QApplication.keyboardModifiers(), QApplication.mouseButtons()
+
+    def capture_size(self, doc_pt, pressure=1.0):
+        # Huella del pincel: tamaño del preset (escalado por presión) más lo
+        # recorrido desde la última muestra, en píxeles de documento (el zoom
+        # de la vista ya está aplicado al mapear el cursor). Centrado en el
+        # punto medio del tramo, el cuadrado cubre los dabs de ambos extremos.
+        # Normal/Wide/Ultra es el margen que se añade alrededor.
+        factor = CAPTURE_MARGIN_FACTORS.get(self.size_multiplier, float(self.size_multiplier))
+        pressure = max(0.0, min(1.0, pressure))
+        footprint = self.brush_size * (1.0 - CAPTURE_PRESSURE_WEIGHT + CAPTURE_PRESSURE_WEIGHT * pressure)
+        if self.is_drawing and self.last_draw_pt is not None:
+            delta = doc_pt - self.last_draw_pt
+            footprint += (delta.x() ** 2 + delta.y() ** 2) ** 0.5
+        return int(max(CAPTURE_MIN_SIZE, min(CAPTURE_MAX_SIZE, ceil(footprint * factor))))
+
+    def refresh_brush_size(self):
+        self.brush_size_time = self.clock()
+        try:
+            view = self.app_ref.activeWindow().activeView()
+            self.brush_size = max(1.0, float(view.brushSize()))
+        except Exception:
+            self.brush_size = float(BASE_CAMERA_SIZE)
+
+    def _calculate_geometry(self, global_pos, pressure=1.0):
         doc_pt = self.map_pos_to_document_absolute(global_pos)
         if not doc_pt: return None
         vs = self.view_state
-        rel_x = doc_pt.x() - vs.src_rect.x()
-        rel_y = doc_pt.y() - vs.src_rect.y()
+        center = doc_pt
+        if self.is_drawing and self.last_draw_pt is not None:
+            center = (doc_pt + self.last_draw_pt) / 2.0
+        rel_x = center.x() - vs.src_rect.x()
+        rel_y = center.y() - vs.src_rect.y()
         center_widget_x = (rel_x * vs.scale) 
         center_widget_y = (rel_y * vs.scale) 
-        crop_size = int(BASE_CAMERA_SIZE * self.size_multiplier)
-        crop_x = int(doc_pt.x() - crop_size / 2)
-        crop_y = int(doc_pt.y() - crop_size / 2)
+        crop_size = self.capture_size(doc_pt, pressure)
+        if self.is_drawing:
+            self.last_draw_pt = doc_pt
+        crop_x = int(center.x() - crop_size / 2)
+        crop_y = int(center.y() - crop_size / 2)
         patch_display_size = crop_size * vs.scale
         dest_x = center_widget_x - (patch_display_size / 2.0)
         dest_y = center_widget_y - (patch_display_size / 2.0)
@@ -418,83 +1925,94 @@ class InputInterceptor(QObject):
         return (crop_x, crop_y, crop_size, dest_rect)
 
     def process_hover(self, event):
-        now = time.time()
+        now = self.clock()
         if (now - self.last_process_time) < 0.005: return
         self.last_process_time = now
+        # brushSize() cruza a C++ en cada llamada: al pasar el cursor basta refrescarlo de vez en cuando
+        if now - self.brush_size_time >= BRUSH_SIZE_REFRESH_S:
+            self.refresh_brush_size()
         geom = self._calculate_geometry(event.globalPos())
         if not geom: return
-        _, _, _, dest_rect = geom
+        crop_x, crop_y, crop_size, dest_rect = geom
         self.main_viewport.update_cursor_pos(dest_rect)
+        margin = PREFETCH_TILE_SIZE
+        self.prefetcher.request(QRect(crop_x - margin, crop_y - margin,
+                                      crop_size + 2 * margin, crop_size + 2 * margin), now)
+
+    def read_patch(self, doc, rect):
+        if self.source_mode == 0:
+            node = doc.activeNode()
+            if not node: return None
+            pixel_data = self.broker.read(node, rect)
+            return decode_layer_pixels(pixel_data, rect.width(), rect.height())
+        return self.get_manual_projection(doc, rect.x(), rect.y(), rect.width(), rect.height())
 
-    def get_manual_projection(self, doc, x, y, w, h):
+    def get_manual_projection(self, doc, x, y, w, h, refresh=False):
         view_rect = QRect(x, y, w, h)
         final_image = QImage(w, h, QImage.Format_ARGB32_Premultiplied)
         final_image.fill(Qt.transparent)
-        painter = QPainter(final_image)
-        painter.setRenderHint(QPainter.Antialiasing, False)
-        painter.setRenderHint(QPainter.SmoothPixmapTransform, False)
+        return self.compositor.compose(final_image, view_rect, self.read_layers(doc, view_rect, refresh))
 
-        def render_node_recursive(node):
+    def read_layers(self, doc, view_rect, refresh=False):
+        # Generador: lee (hilo principal) cada capa visible en el orden de composición.
+        # refresh: se lee todo view_rect sin consultar el índice de ocupación y
+        # con esos bytes se rehace (una sola pasada para proyectar y reescanear).
+        def read_node_recursive(node):
             for child in node.childNodes():
                 if not child.visible(): continue
                 if "Group" in child.type():
-                    render_node_recursive(child)
+                    yield from read_node_recursive(child)
                 else:
                     layer_bounds = child.bounds()
                     if layer_bounds.isEmpty(): continue
                     rect_visible = view_rect.intersected(layer_bounds)
                     if rect_visible.isEmpty(): continue
-                    pixel_data = child.pixelData(
-                        rect_visible.x(), rect_visible.y(), 
-                        rect_visible.width(), rect_visible.height()
-                    )
-                    if not pixel_data: continue
-                    rw = rect_visible.width()
-                    rh = rect_visible.height()
-                    expected_len = rw * rh
-                    layer_img = None
-                    if len(pixel_data) == expected_len * 4:
-                        layer_img = QImage(pixel_data, rw, rh, QImage.Format_RGBA8888).rgbSwapped()
-                    elif len(pixel_data) == expected_len * 8:
-                        layer_img = QImage(pixel_data, rw, rh, rw * 8, QImage.Format_RGBA64).rgbSwapped()
-                    if layer_img and not layer_img.isNull():
-                        if layer_img.format() != QImage.Format_ARGB32_Premultiplied:
-                            layer_img = layer_img.convertToFormat(QImage.Format_ARGB32_Premultiplied)
-                        target_x = rect_visible.x() - view_rect.x()
-                        target_y = rect_visible.y() - view_rect.y()
-                        painter.setOpacity(child.opacity() / 255.0)
-                        mode_str = child.blendingMode()
-                        comp_mode = BLEND_MODES_MAP.get(mode_str, QPainter.CompositionMode_SourceOver)
-                        painter.setCompositionMode(comp_mode)
-                        painter.drawImage(target_x, target_y, layer_img)
-
+                    # Los tiles totalmente transparentes no se leen ni se componen
+                    if self.occupancy is not None and not refresh:
+                        rects = self.occupancy.occupied_rects(child, rect_visible)
+                    else:
+                        rects = [rect_visible]
+                    if not rects: continue
+                    mode_str = child.blendingMode()
+                    comp_mode = BLEND_MODES_MAP.get(mode_str, QPainter.CompositionMode_SourceOver)
+                    if self.raster_cache.handles(child):
+                        chunks = self.raster_cache.chunks(child, rects, frame)
+                    else:
+                        chunks = self.broker.read_many(child, rects, merged=True)
+                    if refresh and self.occupancy is not None:
+                        self.occupancy.record(child, chunks)
+                    yield child.opacity() / 255.0, comp_mode, chunks
+
+        frame = document_frame(doc)
         root = doc.rootNode()
         if root:
-            render_node_recursive(root)
-        painter.end()
-        return final_image
+            yield from read_node_recursive(root)
 
     def process_draw(self, event):
-        now = time.time()
+        now = self.clock()
         if (now - self.last_process_time) < self.min_interval: return
         self.last_process_time = now
-        geom = self._calculate_geometry(event.globalPos())
+        is_tablet = event.type() in (QEvent.TabletPress, QEvent.TabletMove)
+        geom = self._calculate_geometry(event.globalPos(), event.pressure() if is_tablet else 1.0)
         if not geom: return
         crop_x, crop_y, crop_size, dest_rect = geom
         doc = self.app_ref.activeDocument()
         qimg_patch = None
         if doc:
-            if self.source_mode == 0: 
-                node = doc.activeNode()
-                if node:
-                    pixel_data = node.pixelData(crop_x, crop_y, crop_size, crop_size)
-                    len_data = len(pixel_data)
-                    if len_data == crop_size * crop_size * 4:
-                        qimg_patch = QImage(pixel_data, crop_size, crop_size, QImage.Format_RGBA8888).rgbSwapped()
-                    elif len_data == crop_size * crop_size * 8:
-                        qimg_patch = QImage(pixel_data, crop_size, crop_size, crop_size * 8, QImage.Format_RGBA64).rgbSwapped()
-            else: 
-                qimg_patch = self.get_manual_projection(doc, crop_x, crop_y, crop_size, crop_size)
+            crop_rect = QRect(crop_x, crop_y, crop_size, crop_size)
+            center = QPointF(crop_rect.center())
+            if doc.activeNode():
+                # La capa activa (y sus clones) cambia con cada muestra
+                self.raster_cache.note_edit(doc.activeNode())
+            self.prefetcher.note_sample(center, now)
+            qimg_patch = self.prefetcher.fetch(doc, crop_rect)
+            ahead = self.prefetcher.velocity() * PREFETCH_LOOKAHEAD_S
+            self.prefetcher.request(crop_rect.translated(int(ahead.x()), int(ahead.y())), now)
+            if self.occupancy is not None and doc.activeNode():
+                # Zona sucia del trazo (con margen para pinceles mayores que el parche)
+                margin = crop_size // 2
+                self.occupancy.mark_dirty(doc.activeNode(), QRect(crop_x - margin, crop_y - margin,
+                                                                  crop_size + 2 * margin, crop_size + 2 * margin))
         if qimg_patch:
             self.camera_preview.update_image(qimg_patch)
             self.main_viewport.stamp_trail(qimg_patch, dest_rect, dest_rect)
@@ -524,45 +2042,37 @@ class InputInterceptor(QObject):
         except:
             return QTransform()
 
-    def map_pos_to_document_absolute(self, global_pos):
+    def global_view_transform(self, global_pos):
+        # Documento -> coordenadas globales de pantalla del widget bajo el cursor
         try:
             app = self.app_ref
             doc = app.activeDocument()
             view = app.activeWindow().activeView()
             if not doc or not view: return None
-            canvas = view.canvas()
             target_widget = QApplication.widgetAt(global_pos)
             if target_widget and target_widget != self.main_viewport: pass 
             else: target_widget = QApplication.focusWidget() or app.activeWindow().qwindow().centralWidget()
             if not target_widget: return None
-            local_pos = target_widget.mapFromGlobal(global_pos)
-            t_flake = view.flakeToCanvasTransform()
-            origin = t_flake.map(QPointF(0.0, 0.0))
-            res = doc.resolution() or 72.0
-            zoom = canvas.zoomLevel()
-            scale_factor = (72.0 / res) * zoom
-            doc_x_scaled = local_pos.x() - origin.x()
-            doc_y_scaled = local_pos.y() - origin.y()
-            rotation = canvas.rotation()
-            if rotation != 0:
-                angle_rad = -rotation * 3.14159265359 / 180.0
-                cos_a = cos(angle_rad)
-                sin_a = sin(angle_rad)
-                tx = doc_x_scaled * cos_a - doc_y_scaled * sin_a
-                ty = doc_x_scaled * sin_a + doc_y_scaled * cos_a
-                doc_x_scaled = tx
-                doc_y_scaled = ty
-            if canvas.mirror(): doc_x_scaled = -doc_x_scaled
-            return QPointF(doc_x_scaled / scale_factor, doc_y_scaled / scale_factor)
+            widget_origin = target_widget.mapToGlobal(QPoint(0, 0))
+            return self.get_current_view_transform() * QTransform.fromTranslate(widget_origin.x(), widget_origin.y())
         except: return None
 
+    def map_pos_to_document_absolute(self, global_pos):
+        transform = self.global_view_transform(global_pos)
+        if transform is None: return None
+        inverse, invertible = transform.inverted()
+        if not invertible: return None
+        return inverse.map(QPointF(global_pos))
+
 # =========================================================================================
 # CLASE 5: DOCKER PRINCIPAL
 # =========================================================================================
 class CameraMonitorDocker(DockWidget):
-    def __init__(self):
+    def __init__(self, settings_path=None):
+        startup_t0 = time.perf_counter()
         super().__init__()
         self.setWindowTitle("Infinite Canvas")
+        self.stats = {}
         
         self.baseWidget = QWidget()
         self.vbox = QVBoxLayout()
@@ -571,7 +2081,7 @@ class CameraMonitorDocker(DockWidget):
         self.setWidget(self.baseWidget)
         
         self.current_color = QColor(0, 0, 255) # Azul por defecto
-        self.settings_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "infinite_canvas_settings.txt")
+        self.settings_path = settings_path or os.path.join(os.path.dirname(os.path.realpath(__file__)), "infinite_canvas_settings.txt")
 
         # --- TOOLBAR 1 ---
         toolbar = QWidget()
@@ -586,7 +2096,8 @@ class CameraMonitorDocker(DockWidget):
         self.btn_active.clicked.connect(self.save_settings)
         
         self.combo_size = QComboBox()
-        self.combo_size.addItems(["Normal (1x)", "Wide (3x)", "Ultra (5x)"])
+        self.combo_size.addItems(["Normal", "Wide", "Ultra"])
+        self.combo_size.setToolTip("Margen capturado alrededor de la huella del pincel")
         self.combo_size.currentIndexChanged.connect(self.save_settings)
         self.combo_size.currentIndexChanged.connect(self.update_settings)
         
@@ -604,12 +2115,25 @@ class CameraMonitorDocker(DockWidget):
         self.btn_color.setFixedSize(20, 20)
         self.btn_color.setStyleSheet(f"background-color: {self.current_color.name()}; border: 1px solid gray;")
         self.btn_color.clicked.connect(self.select_color)
+
+        self.btn_record = QToolButton()
+        self.btn_record.setText("Rec")
+        self.btn_record.setCheckable(True)
+        self.btn_record.setToolTip("Grabar eventos de entrada para reproducirlos con headless.py")
+        self.btn_record.toggled.connect(self.toggle_recording)
+
+        self.btn_export = QToolButton()
+        self.btn_export.setText("Export")
+        self.btn_export.setToolTip("Exportar todo el contenido (también fuera del canvas) a PNG")
+        self.btn_export.clicked.connect(self.export_full_content)
         
         hbox.addWidget(self.btn_active)
         hbox.addWidget(self.combo_size)
         hbox.addWidget(self.combo_source)
         hbox.addWidget(self.chk_reticle)
         hbox.addWidget(self.btn_color) 
+        hbox.addWidget(self.btn_record)
+        hbox.addWidget(self.btn_export)
         hbox.addStretch()
         self.vbox.addWidget(toolbar)
 
@@ -650,13 +2174,73 @@ class CameraMonitorDocker(DockWidget):
         hbox2.addWidget(self.chk_outline)
         hbox2.addWidget(QLabel("Op:"))
         hbox2.addWidget(self.slider_opacity)
+
+        self.spin_workers = QSpinBox()
+        self.spin_workers.setRange(0, 64)
+        self.spin_workers.setSpecialValueText("Auto")
+        self.spin_workers.setToolTip("Hilos para componer Full Document (Auto = uno por núcleo)")
+        self.spin_workers.valueChanged.connect(self.save_settings)
+        self.spin_workers.valueChanged.connect(self.update_settings)
+        hbox2.addWidget(QLabel("Threads:"))
+        hbox2.addWidget(self.spin_workers)
         hbox2.addStretch()
         self.vbox.addWidget(toolbar2)
 
+        # Los widgets pesados (viewport OpenGL, preview, interceptor) y los
+        # enganches a acciones de Krita se crean en ensure_initialized().
+        self.initialized = False
+        self.splitter = None
+        self.main_viewport = None
+        self.camera_preview = None
+        self.interceptor = None
+        self.view_state = ViewState()
+        self.occupancy = TileOccupancyIndex()
+        self.presenter = PresentationScheduler(self)
+        self.frame_cache = FrameProjectionCache()
+        self.current_frame = None
+        self.projection_pending = False
+        
+        self.app_instance = QApplication.instance()
+        
+        self.overlay = None
+        self.target_viewport = None
+        self.overlay_sync_key = None
+        self.sync_timer = QTimer(self)
+        self.sync_timer.timeout.connect(self.sync_overlay_geometry)
+        
+        self.monitor_timer = QTimer(self)
+        self.monitor_timer.timeout.connect(self.check_bounds_change)
+
+        self.activity = ActivityScheduler(self)
+        self.activity.add_loop("sync", self.sync_timer, SYNC_INTERVAL_MS, SYNC_MAX_INTERVAL_MS)
+        self.activity.add_loop("monitor", self.monitor_timer, MONITOR_INTERVAL_MS, MONITOR_MAX_INTERVAL_MS)
+        
+        self.load_settings()
+        self.update_settings()
+        self.stats["startup_ms"] = (time.perf_counter() - startup_t0) * 1000.0
+
+    def current_stats(self):
+        data = dict(self.stats)
+        data.update(self.activity.stats())
+        data.update(self.frame_cache.stats())
+        if self.interceptor:
+            data.update(self.interceptor.raster_cache.stats())
+            data.update(self.interceptor.broker.stats())
+        return data
+
+    def showEvent(self, event):
+        self.ensure_initialized()
+        super().showEvent(event)
+
+    def ensure_initialized(self):
+        if self.initialized: return
+        self.initialized = True
+        init_t0 = time.perf_counter()
+
         self.splitter = QSplitter(Qt.Vertical)
         self.vbox.addWidget(self.splitter)
 
-        self.main_viewport = MainViewportWidget()
+        self.main_viewport = MainViewportWidget(scheduler=self.presenter)
         self.splitter.addWidget(self.main_viewport)
         
         self.cam_container = QWidget()
@@ -667,13 +2251,13 @@ class CameraMonitorDocker(DockWidget):
         self.cam_label = QLabel("Preview")
         cam_layout.addWidget(self.cam_label)
         
-        self.camera_preview = CameraPreviewWidget()
+        self.camera_preview = CameraPreviewWidget(scheduler=self.presenter)
         cam_layout.addWidget(self.camera_preview)
         
         self.splitter.addWidget(self.cam_container)
 
-        self.view_state = ViewState()
-        self.interceptor = InputInterceptor(self.view_state, self.main_viewport, self.camera_preview)
+        self.interceptor = InputInterceptor(self.view_state, self.main_viewport, self.camera_preview, self.occupancy)
+        self.interceptor.activity = self.activity
         self.interceptor.stroke_finished.connect(self.on_stroke_finished)
         self.interceptor.live_patch_ready.connect(self.relay_patch_to_overlay)
         
@@ -688,20 +2272,39 @@ class CameraMonitorDocker(DockWidget):
             print(f"Error conectando acciones: {e}")
         
         self.main_viewport.contentChanged.connect(self.refresh_overlay)
-        
-        self.app_instance = QApplication.instance()
-        
-        self.overlay = None
-        self.target_viewport = None
-        self.sync_timer = QTimer(self)
-        self.sync_timer.timeout.connect(self.sync_overlay_geometry)
-        
-        self.monitor_timer = QTimer(self)
-        self.monitor_timer.setInterval(100) 
-        self.monitor_timer.timeout.connect(self.check_bounds_change)
-        
-        self.load_settings()
+
         self.update_settings()
+        self.update_visibility()
+        self.stats["lazy_init_ms"] = (time.perf_counter() - init_t0) * 1000.0
+        if Krita.instance().activeDocument():
+            self.request_full_canvas()
+
+    def request_full_canvas(self):
+        # Primera proyección (y las de canvasChanged) asíncronas: se ejecutan
+        # cuando el bucle de eventos queda ocioso, y varias peticiones se funden en una.
+        if self.projection_pending: return
+        self.projection_pending = True
+        dispatcher = QAbstractEventDispatcher.instance()
+        if dispatcher is None:
+            QTimer.singleShot(0, self._run_pending_projection)
+            return
+        dispatcher.aboutToBlock.connect(self._on_event_loop_idle)
+
+    def _on_event_loop_idle(self):
+        try: QAbstractEventDispatcher.instance().aboutToBlock.disconnect(self._on_event_loop_idle)
+        except TypeError: pass
+        QTimer.singleShot(0, self._run_pending_projection)
+
+    def _run_pending_projection(self):
+        if not self.projection_pending: return
+        self.projection_pending = False
+        t0 = time.perf_counter()
+        try:
+            self.update_full_canvas(force=True)
+        except RuntimeError:
+            return
+        if "first_projection_ms" not in self.stats and self.view_state.valid:
+            self.stats["first_projection_ms"] = (time.perf_counter() - t0) * 1000.0
 
     def select_color(self):
         color = QColorDialog.getColor(self.current_color, self, "Seleccionar Color Overlay")
@@ -726,7 +2329,8 @@ class CameraMonitorDocker(DockWidget):
                 "crop": self.chk_crop.isChecked(),
                 "outline": self.chk_outline.isChecked(),
                 "opacity": self.slider_opacity.value(),
-                "color": self.current_color.name()
+                "color": self.current_color.name(),
+                "workers": self.spin_workers.value()
             }
             with open(self.settings_path, 'w') as f:
                 json.dump(data, f)
@@ -738,7 +2342,12 @@ class CameraMonitorDocker(DockWidget):
         try:
             with open(self.settings_path, 'r') as f:
                 data = json.load(f)
-            self.blockSignals(True)
+            # Bloquear las señales de los propios controles: restaurar la configuración no debe
+            # disparar guardados parciales, proyecciones ni la inicialización de los widgets pesados.
+            controls = (self.btn_active, self.combo_size, self.combo_source, self.chk_reticle,
+                        self.chk_overlay, self.chk_no_color, self.chk_crop, self.chk_outline,
+                        self.slider_opacity, self.spin_workers)
+            blocked = [w.blockSignals(True) for w in controls]
             self.combo_size.setCurrentIndex(data.get("size_index", 0))
             self.combo_source.setCurrentIndex(data.get("source_index", 0))
             self.chk_reticle.setChecked(data.get("reticle", True))
@@ -747,6 +2356,7 @@ class CameraMonitorDocker(DockWidget):
             self.chk_crop.setChecked(data.get("crop", False))
             self.chk_outline.setChecked(data.get("outline", False))
             self.slider_opacity.setValue(data.get("opacity", 100))
+            self.spin_workers.setValue(data.get("workers", 0))
             color_name = data.get("color", "#0000ff")
             self.current_color = QColor(color_name)
             self.btn_color.setStyleSheet(f"background-color: {self.current_color.name()}; border: 1px solid gray;")
@@ -754,10 +2364,14 @@ class CameraMonitorDocker(DockWidget):
             self.btn_active.setChecked(was_active)
             if was_active:
                 self.btn_active.setText("Disable")
-                self.toggle_tracking()
+                # El filtro global y los widgets pesados se activan cuando Krita termina de arrancar
+                QTimer.singleShot(0, self.resume_tracking)
             else:
                 self.btn_active.setText("Enable")
-            self.blockSignals(False)
+            if self.chk_overlay.isChecked():
+                QTimer.singleShot(0, self.resume_overlay)
+            for w, was_blocked in zip(controls, blocked):
+                w.blockSignals(was_blocked)
             self.update_settings()
             self.update_visibility()
             self.update_overlay_settings()
@@ -772,7 +2386,8 @@ class CameraMonitorDocker(DockWidget):
             return
 
         if canvas:
-            self.update_full_canvas(force=True)
+            self.occupancy.invalidate()
+            self.request_full_canvas()
             
             # PROTECCIÓN DE ERROR "wrapped C/C++ object ... deleted"
             try:
@@ -804,6 +2419,7 @@ class CameraMonitorDocker(DockWidget):
             self.overlay = None
 
     def update_settings(self):
+        if not self.interceptor: return
         size_idx = self.combo_size.currentIndex()
         mult = 1
         if size_idx == 1: mult = 3
@@ -811,8 +2427,10 @@ class CameraMonitorDocker(DockWidget):
         self.interceptor.set_multiplier(mult)
         mode = self.combo_source.currentIndex()
         self.interceptor.set_mode(mode)
+        self.interceptor.compositor.set_workers(self.spin_workers.value())
 
     def update_visibility(self):
+        if not self.main_viewport: return
         visible = self.chk_reticle.isChecked()
         self.main_viewport.set_reticle_visible(visible)
 
@@ -828,24 +2446,113 @@ class CameraMonitorDocker(DockWidget):
             except RuntimeError:
                 self.overlay = None
 
+    def resume_tracking(self):
+        try:
+            if self.btn_active.isChecked() and not (self.interceptor and self.interceptor.active):
+                self.toggle_tracking()
+        except RuntimeError:
+            pass
+
+    def resume_overlay(self):
+        try:
+            if self.chk_overlay.isChecked() and not self.overlay:
+                self.toggle_overlay(True)
+        except RuntimeError:
+            pass
+
     def toggle_tracking(self):
         is_active = self.btn_active.isChecked()
         if is_active:
+            self.ensure_initialized()
             self.btn_active.setText("Disable")
             self.interceptor.active = True
             self.app_instance.installEventFilter(self.interceptor)
-            self.monitor_timer.start() 
-            self.update_full_canvas(force=True)
+            # Lo editado con el seguimiento apagado no invalidó nada
+            self.occupancy.invalidate()
+            self.frame_cache.clear()
+            self.interceptor.raster_cache.clear()
+            self.activity.start("monitor")
+            self.request_full_canvas()
         else:
             self.btn_active.setText("Enable")
+            self.activity.stop("monitor")
+            # Sin seguimiento nada marca zonas sucias: el índice dejaría de ser fiable
+            self.occupancy.invalidate()
+            if not self.interceptor: return
             self.interceptor.active = False
             self.app_instance.removeEventFilter(self.interceptor)
-            self.monitor_timer.stop()
+
+    def toggle_recording(self, checked):
+        if checked:
+            self.ensure_initialized()
+            try:
+                folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), "recordings")
+                os.makedirs(folder, exist_ok=True)
+                path = os.path.join(folder, time.strftime("stroke_%Y%m%d_%H%M%S.icstroke"))
+                doc = Krita.instance().activeDocument()
+                header = {
+                    "version": 1,
+                    "doc_width": doc.width() if doc else 0,
+                    "doc_height": doc.height() if doc else 0,
+                    "resolution": (doc.resolution() or 72.0) if doc else 72.0,
+                    "source_mode": self.interceptor.source_mode,
+                    "size_multiplier": self.interceptor.size_multiplier,
+                    "min_interval": self.interceptor.min_interval,
+                }
+                self.interceptor.recorder = StrokeRecorder(path, header)
+                print(f"Grabando trazos en {path}")
+            except Exception as e:
+                print(f"Error iniciando grabación: {e}")
+                self.btn_record.setChecked(False)
+        elif self.interceptor and self.interceptor.recorder:
+            recorder = self.interceptor.recorder
+            self.interceptor.recorder = None
+            recorder.close()
+            print(f"Grabación terminada: {recorder.events} eventos en {recorder.path}")
+
+    def export_full_content(self):
+        self.ensure_initialized()
+        doc = Krita.instance().activeDocument()
+        if not doc: return
+        # Lo editado sin seguimiento (filtros, otras capas...) no invalidó el
+        # índice de ocupación ni la caché raster: se reconstruyen leyendo de nuevo
+        self.occupancy.invalidate()
+        self.interceptor.raster_cache.clear()
+        self.interceptor.broker.end_tick()
+        if self.combo_source.currentIndex() == 0:
+            node = doc.activeNode()
+            if not node: return
+            b = node.bounds()
+            x, y, w, h = b.x(), b.y(), b.width(), b.height()
+        else:
+            x, y, w, h = self.calculate_total_bounds(doc)
+        if w <= 0 or h <= 0: return
+        base = os.path.splitext(os.path.basename(doc.fileName() or "infinite_canvas"))[0]
+        path, _ = QFileDialog.getSaveFileName(self, "Exportar contenido", base + "_full.png", "PNG (*.png)")
+        if not path: return
+        progress = QProgressDialog(f"Exportando {w} x {h} px...", "Cancelar", 0, h, self)
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(0)
+
+        def on_progress(done, total):
+            progress.setValue(done)
+            return not progress.wasCanceled()
+
+        try:
+            if export_projection(self.interceptor, doc, QRect(x, y, w, h), path, on_progress):
+                print(f"Exportado {w} x {h} px en {path}")
+        except Exception as e:
+            print(f"Error exportando: {e}")
+        finally:
+            progress.close()
 
     def on_stroke_finished(self):
         self.view_state.last_bounds_hash = None
+        self.invalidate_edited_frames()
         
         def safe_update():
+            # Krita termina de pintar de forma asíncrona: la primera proyección puede ir atrasada
+            self.invalidate_edited_frames()
             try: self.update_full_canvas(force=True)
             except RuntimeError: pass
 
@@ -854,18 +2561,47 @@ class CameraMonitorDocker(DockWidget):
         
     def on_history_action(self):
         self.view_state.last_bounds_hash = None
+        self.occupancy.invalidate()
+        if self.interceptor: self.interceptor.prefetcher.clear()
         
         def safe_update():
+            # Se asume que deshacer/rehacer/pegar actúa sobre el fotograma actual
+            self.invalidate_edited_frames()
             try: self.update_full_canvas(force=True)
             except RuntimeError: pass
             
         QTimer.singleShot(100, safe_update)
 
+    def invalidate_edited_frames(self):
+        try:
+            doc = Krita.instance().activeDocument()
+            node = doc.activeNode() if doc else None
+            if node:
+                self.frame_cache.invalidate_edit(doc, node, document_frame(doc))
+                if self.interceptor: self.interceptor.raster_cache.note_edit(node)
+        except RuntimeError:
+            pass
+
+    def invalidate_animated(self, node):
+        # El contenido de las capas animadas cambia con el fotograma
+        for child in node.childNodes():
+            if node_animated(child):
+                self.occupancy.invalidate(child)
+            self.invalidate_animated(child)
+
+    def check_frame_change(self, doc):
+        # Krita no avisa del cambio de fotograma: se sondea desde sync y monitor
+        if self.current_frame is None or document_frame(doc) == self.current_frame: return False
+        self.activity.note_activity()
+        self.update_full_canvas(force=True, reuse_frames=True)
+        return True
+
     def check_bounds_change(self):
-        if self.combo_source.currentIndex() == 1: return
         try:
             doc = Krita.instance().activeDocument()
             if not doc: return
+            if self.check_frame_change(doc): return
+            if self.combo_source.currentIndex() == 1: return
             node = doc.activeNode()
             if not node: return
             bounds = node.bounds()
@@ -878,7 +2614,8 @@ class CameraMonitorDocker(DockWidget):
         except:
             pass
 
-    def calculate_total_bounds(self, doc):
+    def calculate_total_bounds(self, doc, tight=True):
+        # tight: bounds del índice de ocupación; si no, los de Krita (sin leer píxeles)
         total_rect = QRect()
         hay_contenido = False
         def crawl_bounds(node):
@@ -888,7 +2625,7 @@ class CameraMonitorDocker(DockWidget):
                 if "Group" in child.type():
                     crawl_bounds(child)
                 else:
-                    b = child.bounds()
+                    b = self.occupancy.content_bounds(child) if tight else child.bounds()
                     if not b.isEmpty():
                         if not hay_contenido:
                             total_rect = QRect(b)
@@ -902,7 +2639,7 @@ class CameraMonitorDocker(DockWidget):
             return 0, 0, doc.width(), doc.height()
         return total_rect.x(), total_rect.y(), total_rect.width(), total_rect.height()
 
-    def update_full_canvas(self, force=False):
+    def update_full_canvas(self, force=False, reuse_frames=False):
         try:
             # SAFETY CHECK: Si main_viewport no existe, abortar
             if not self.main_viewport: return
@@ -915,16 +2652,35 @@ class CameraMonitorDocker(DockWidget):
             doc = Krita.instance().activeDocument()
             if not doc: return
             mode = self.combo_source.currentIndex()
+            frame = document_frame(doc)
+            if frame != self.current_frame:
+                if self.current_frame is not None:
+                    self.invalidate_animated(doc.rootNode())
+                self.current_frame = frame
+            cache_key = FrameProjectionCache.key(doc, frame, mode)
             if mode == 0:
                 node = doc.activeNode()
                 if not node: return
                 bounds = node.bounds()
                 x, y, w, h = bounds.x(), bounds.y(), bounds.width(), bounds.height()
                 if w <= 0: x, y, w, h = 0, 0, doc.width(), doc.height()
+                cached = self.frame_cache.get(cache_key, QRect(x, y, w, h)) if reuse_frames else None
             else:
-                x, y, w, h = self.calculate_total_bounds(doc)
+                cached = self.frame_cache.get(cache_key) if reuse_frames else None
+                if cached:
+                    x, y, w, h = cached[0].getRect()
+                else:
+                    # Se proyecta sobre los bounds de Krita reescaneando la ocupación
+                    # con las mismas lecturas, y luego se recorta al contenido real
+                    x, y, w, h = self.calculate_total_bounds(doc, tight=False)
+                    projection = self.interceptor.get_manual_projection(doc, x, y, w, h, refresh=True)
+                    content = QRect(*self.calculate_total_bounds(doc))
+                    if projection and content != QRect(x, y, w, h):
+                        projection = projection.copy(content.translated(-x, -y))
+                    x, y, w, h = content.getRect()
 
             self.view_state.last_bounds_hash = (x, y, w, h)
+            self.interceptor.prefetcher.clear()
             scale_ratio = 1.0
             max_dim = max(w, h)
             if max_dim > MAX_BUFFER_SIZE:
@@ -943,14 +2699,18 @@ class CameraMonitorDocker(DockWidget):
             self.view_state.offset_y = 0 
             self.view_state.valid = True
             
-            if force or target_w > 0:
+            if cached:
+                self.main_viewport.set_base_background(cached[1])
+                if self.overlay:
+                    self.overlay.clear_live_buffer()
+            elif force or target_w > 0:
                 full_img = None
                 if mode == 0: 
                     node = doc.activeNode()
                     if node:
                         full_img = node.thumbnail(target_w, target_h)
                 else:
-                    full_res_img = self.interceptor.get_manual_projection(doc, x, y, w, h)
+                    full_res_img = projection
                     if full_res_img:
                         full_img = QImage(full_res_img)
                         if full_img.width() != target_w or full_img.height() != target_h:
@@ -960,7 +2720,13 @@ class CameraMonitorDocker(DockWidget):
                                  Qt.SmoothTransformation
                              )
                 if full_img:
-                     self.main_viewport.set_base_background(QPixmap.fromImage(full_img))
+                     pixmap = QPixmap.fromImage(full_img)
+                     # Solo se guarda lo que un cambio de fotograma puede reutilizar
+                     if mode == 0: reusable = node_animated(doc.activeNode())
+                     else: reusable = tree_animated(doc.rootNode())
+                     if reusable:
+                         self.frame_cache.put(cache_key, QRect(x, y, w, h), pixmap)
+                     self.main_viewport.set_base_background(pixmap)
                 if self.overlay:
                     self.overlay.clear_live_buffer()
         except Exception as e:
@@ -971,7 +2737,7 @@ class CameraMonitorDocker(DockWidget):
     def refresh_overlay(self):
         try:
             if self.overlay and self.overlay.isVisible():
-                self.overlay.update()
+                schedule_update(self.overlay)
         except RuntimeError:
             self.overlay = None
 
@@ -995,26 +2761,31 @@ class CameraMonitorDocker(DockWidget):
         # PROTECCIÓN COMPLETA CONTRA OBJETOS BORRADOS
         try:
             if checked:
+                self.ensure_initialized()
                 self.target_viewport = self.find_canvas_viewport()
                 if self.target_viewport:
                     if self.overlay:
                         try: self.overlay.close()
                         except: pass
-                    self.overlay = OverlayWidget(self, parent=self.target_viewport)
+                    self.overlay = OverlayWidget(self, parent=self.target_viewport, scheduler=self.presenter)
+                    self.overlay_sync_key = None
                     self.update_overlay_settings() 
                     self.overlay.show()
                     self.overlay.raise_()
-                    self.sync_timer.start(16)
+                    self.activity.watch(self.target_viewport)
+                    self.activity.start("sync")
                 else:
                     # Si no hay viewport, intentamos desmarcar, pero verificando que exista
                     if self.chk_overlay:
                         self.chk_overlay.setChecked(False)
             else:
                 if self.overlay:
+                    self.presenter.forget(self.overlay)
                     try: self.overlay.close()
                     except: pass
                 self.overlay = None
-                self.sync_timer.stop()
+                self.activity.stop("sync")
+                self.activity.watch(None)
                 if self.target_viewport:
                     try: self.target_viewport.update()
                     except: pass
@@ -1033,10 +2804,21 @@ class CameraMonitorDocker(DockWidget):
                     if self.overlay.geometry() != rect:
                         self.overlay.setGeometry(rect)
                         self.overlay.ensure_buffers()
-                    self.overlay.update()
+                    # Solo se repinta si cambió algo que el overlay dibuja (vista, geometría, documento)
+                    doc = Krita.instance().activeDocument()
+                    if doc: self.check_frame_change(doc)
+                    doc_size = (doc.width(), doc.height()) if doc else None
+                    sync_key = (rect, self.interceptor.get_current_view_transform(), doc_size)
+                    if sync_key != self.overlay_sync_key:
+                        if self.overlay_sync_key is not None:
+                            self.activity.note_activity()
+                        self.overlay_sync_key = sync_key
+                        schedule_update(self.overlay)
             except RuntimeError:
+                self.presenter.forget(self.overlay)
                 self.overlay = None
-                self.sync_timer.stop()
+                self.activity.stop("sync")
+                self.activity.watch(None)
                 try: self.chk_overlay.setChecked(False)
                 except: pass
 
@@ -0,0 +1,521 @@
+"""Herramientas sin Krita para el plugin Infinite Canvas.
+
+Carga canvas_extender.py bajo Qt offscreen con un documento sustituto y
+reproduce grabaciones de trazos (botón "Rec" del docker), mide el arranque
+del docker, la escalabilidad de la composición por hilos o la exportación.
+Con --kra se usa un documento real (ver kra_reader.py) en lugar del sintético:
+
+    python canvas_extender/headless.py replay stroke.icstroke --speed 0
+    python canvas_extender/headless.py startup --tracking
+    python canvas_extender/headless.py bench --width 8000 --height 6000
+    python canvas_extender/headless.py bench --kra ilustracion.kra
+    python canvas_extender/headless.py export salida.png --kra ilustracion.kra
+    python canvas_extender/headless.py kra ilustracion.kra
+"""
+import argparse
+import importlib.util
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtWidgets import QApplication, QDockWidget
+from PyQt5.QtCore import Qt, QEvent, QEventLoop, QPointF, QRect, QTimer
+from PyQt5.QtGui import QImage, QPainter, QColor, QPen, QMouseEvent, QTabletEvent, QTransform
+
+from kra_reader import Document, DocumentNode, read_kra
+
+STAND_IN_BRUSH_SIZE = 40.0
+PLUGIN_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "canvas_extender.py")
+
+# =========================================================================================
+# DOCUMENTO SUSTITUTO
+# =========================================================================================
+class StandInNode(DocumentNode):
+    def __init__(self, name, image=None, x=0, y=0, node_type="paintlayer", opacity=255,
+                 blending_mode="normal", visible=True, children=None, stats=None):
+        super().__init__(name, node_type, x, y, opacity, blending_mode, visible,
+                         children=children, stats=stats)
+        self._image = image.convertToFormat(QImage.Format_ARGB32) if image is not None else None
+
+    def bounds(self):
+        if self._image is None:
+            rect = QRect()
+            for child in self._children:
+                rect = rect.united(child.bounds())
+            return rect
+        return QRect(self._x, self._y, self._image.width(), self._image.height())
+
+    def _read(self, x, y, w, h):
+        if self._image is None:
+            return bytes(w * h * 4)
+        # QImage.copy rellena con transparente lo que queda fuera de la imagen
+        patch = self._image.copy(QRect(x - self._x, y - self._y, w, h))
+        return patch.constBits().asstring(patch.sizeInBytes())
+
+    def thumbnail(self, w, h):
+        if self._image is None: return QImage()
+        return self._image.scaled(w, h, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+
+class StandInDocument(Document):
+    def __init__(self, width, height, root, resolution=72.0, active=None):
+        super().__init__("sustituto", width, height, root, resolution, active)
+
+
+def new_stats():
+    return {"pixel_calls": 0, "bytes_read": 0}
+
+
+def synthetic_document(width=4000, height=3000, layers=3, seed=1, stats=None):
+    # Capas con trazos pseudoaleatorios que se salen del canvas por todos lados.
+    rng = random.Random(seed)
+    margin = max(width, height) // 4
+    nodes = []
+    for index in range(layers):
+        img = QImage(width + 2 * margin, height + 2 * margin, QImage.Format_ARGB32)
+        img.fill(Qt.transparent)
+        painter = QPainter(img)
+        painter.setRenderHint(QPainter.Antialiasing)
+        for _ in range(60):
+            pen = QPen(QColor(rng.randrange(256), rng.randrange(256), rng.randrange(256), 220))
+            pen.setWidth(rng.randrange(4, 80))
+            painter.setPen(pen)
+            points = [QPointF(rng.uniform(0, img.width()), rng.uniform(0, img.height())) for _ in range(4)]
+            for a, b in zip(points, points[1:]):
+                painter.drawLine(a, b)
+        painter.end()
+        nodes.append(StandInNode(f"Layer {index + 1}", img, -margin, -margin,
+                                 opacity=255 if index == 0 else 200, stats=stats))
+    root = StandInNode("root", node_type="grouplayer", children=nodes, stats=stats)
+    return StandInDocument(width, height, root, active=nodes[-1])
+
+# =========================================================================================
+# KRITA SUSTITUTO
+# =========================================================================================
+class _StandInView:
+    def __init__(self, transform):
+        self.transform = transform
+    def canvas(self): return None
+    def flakeToCanvasTransform(self): return QTransform()
+    def brushSize(self): return STAND_IN_BRUSH_SIZE
+
+
+class _StandInWindow:
+    def __init__(self, app):
+        self.app = app
+    def activeView(self): return _StandInView(self.app.view_transform)
+    def qwindow(self): return None
+
+
+class StandInKrita:
+    _instance = None
+
+    def __init__(self):
+        self.document = None
+        self.view_transform = QTransform()
+        self.factories = []
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def activeDocument(self): return self.document
+    def activeWindow(self): return _StandInWindow(self)
+    def action(self, name): return None
+    def addDockWidgetFactory(self, factory): self.factories.append(factory)
+
+
+class _StandInDockWidget(QDockWidget):
+    def canvasChanged(self, canvas): pass
+
+
+class _StandInDockWidgetFactoryBase:
+    DockRight = 2
+    def __init__(self, *args): pass
+
+
+def load_plugin():
+    # Dentro de Krita se usa el módulo real; aquí se instala el sustituto.
+    if "krita" not in sys.modules:
+        try:
+            import krita  # noqa: F401
+        except ImportError:
+            module = types.ModuleType("krita")
+            module.Krita = StandInKrita
+            module.DockWidget = _StandInDockWidget
+            module.DockWidgetFactoryBase = _StandInDockWidgetFactoryBase
+            sys.modules["krita"] = module
+    spec = importlib.util.spec_from_file_location("canvas_extender_headless", PLUGIN_PATH)
+    plugin = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plugin)
+    return plugin
+
+
+def ensure_app():
+    return QApplication.instance() or QApplication([])
+
+# =========================================================================================
+# REPRODUCCIÓN DE TRAZOS
+# =========================================================================================
+TABLET_TYPES = (QEvent.TabletPress, QEvent.TabletRelease, QEvent.TabletMove)
+
+
+def make_replay_interceptor(plugin, view_state, viewport, preview):
+    class ReplayInterceptor(plugin.InputInterceptor):
+        # Estado de entrada, vista y reloj vienen de la grabación, no de Qt/Krita.
+        def __init__(self):
+            super().__init__(view_state, viewport, preview)
+            self.view = QTransform()
+            self.modifiers = Qt.NoModifier
+            self.mouse_buttons = Qt.NoButton
+            self.now = 0.0
+            self.clock = lambda: self.now
+
+        def input_state(self): return self.modifiers, self.mouse_buttons
+        def global_view_transform(self, global_pos): return QTransform(self.view)
+        def get_current_view_transform(self): return QTransform(self.view)
+
+    return ReplayInterceptor()
+
+
+def build_event(record):
+    _, _, _, etype, gx, gy, button, buttons, modifiers, pressure = record
+    etype = QEvent.Type(etype)
+    pos = QPointF(gx, gy)
+    if etype in TABLET_TYPES:
+        return QTabletEvent(etype, pos, pos, QTabletEvent.Stylus, QTabletEvent.Pen, pressure,
+                            0, 0, 0.0, 0.0, 0, Qt.KeyboardModifiers(modifiers), 0,
+                            Qt.MouseButton(button), Qt.MouseButtons(buttons))
+    return QMouseEvent(etype, pos, pos, pos, Qt.MouseButton(button), Qt.MouseButtons(buttons),
+                       Qt.KeyboardModifiers(modifiers))
+
+
+def percentile(values, fraction):
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def replay(path, document=None, speed=1.0, source_mode=None):
+    # speed: 1.0 tiempo real, >1 acelerado, 0 tan rápido como sea posible.
+    # El reloj del interceptor siempre es el de la grabación, así que el
+    # throttling (y por tanto las muestras descartadas) es determinista.
+    app = ensure_app()
+    plugin = load_plugin()
+    header, records = plugin.StrokeRecorder.read(path)
+    stats = new_stats()
+    if document is None:
+        document = synthetic_document(header.get("doc_width") or 4000, header.get("doc_height") or 3000,
+                                      stats=stats)
+    else:
+        _attach_stats(document.rootNode(), stats)
+    krita_app = plugin.Krita.instance()
+    krita_app.document = document
+
+    view_state = plugin.ViewState()
+    x, y, w, h = _document_bounds(document)
+    view_state.src_rect = QRect(x, y, w, h)
+    view_state.scale = min(1.0, plugin.MAX_BUFFER_SIZE / float(max(w, h, 1)))
+    view_state.valid = True
+    scheduler = plugin.PresentationScheduler()
+    viewport = plugin.MainViewportWidget(scheduler=scheduler)
+    viewport.init_buffers(int(w * view_state.scale), int(h * view_state.scale))
+    preview = plugin.CameraPreviewWidget(scheduler=scheduler)
+    interceptor = make_replay_interceptor(plugin, view_state, viewport, preview)
+    interceptor.active = True
+    interceptor.set_mode(header.get("source_mode", 0) if source_mode is None else source_mode)
+    interceptor.set_multiplier(header.get("size_multiplier", 1))
+    interceptor.min_interval = header.get("min_interval", interceptor.min_interval)
+    patches = []
+    interceptor.live_patch_ready.connect(lambda *args: patches.append(1))
+
+    # Latencia por evento = eventFilter + lo que dejó diferido (singleShot(0),
+    # temporizadores vencidos) y corre en la misma vuelta del bucle de eventos
+    latencies = []
+    deferred = []
+    draw_samples = 0
+    start = time.perf_counter()
+    for record in records:
+        t = record[1]
+        if speed > 0:
+            delay = start + t / speed - time.perf_counter()
+            if delay > 0: time.sleep(delay)
+        interceptor.now = t
+        if record[0] == b'V':
+            interceptor.view = QTransform(*record[2:4], 0.0, *record[4:6], 0.0, *record[6:8], 1.0)
+            continue
+        interceptor.modifiers = Qt.KeyboardModifiers(record[8])
+        interceptor.mouse_buttons = Qt.MouseButtons(record[7])
+        event = build_event(record)
+        t0 = time.perf_counter()
+        interceptor.eventFilter(None, event)
+        t1 = time.perf_counter()
+        app.processEvents()
+        t2 = time.perf_counter()
+        latencies.append(t2 - t0)
+        deferred.append(t2 - t1)
+        if interceptor.is_drawing and event.type() not in (QEvent.MouseButtonRelease, QEvent.TabletRelease):
+            draw_samples += 1
+    wall = time.perf_counter() - start
+    return {
+        "file": os.path.basename(path),
+        "file_bytes": os.path.getsize(path),
+        "events": len(latencies),
+        "draw_samples": draw_samples,
+        "patches": len(patches),
+        "dropped_samples": max(0, draw_samples - len(patches)),
+        "pixel_requests": interceptor.broker.requests,
+        "pixel_calls": stats["pixel_calls"],
+        "bytes_read": stats["bytes_read"],
+        "prefetch_hit_tiles": interceptor.prefetcher.hits,
+        "prefetch_miss_tiles": interceptor.prefetcher.misses,
+        "latency_mean_ms": 1000.0 * sum(latencies) / max(1, len(latencies)),
+        "latency_p50_ms": 1000.0 * percentile(latencies, 0.50),
+        "latency_p95_ms": 1000.0 * percentile(latencies, 0.95),
+        "latency_max_ms": 1000.0 * max(latencies, default=0.0),
+        "deferred_mean_ms": 1000.0 * sum(deferred) / max(1, len(deferred)),
+        "deferred_total_ms": 1000.0 * sum(deferred),
+        "wall_s": wall,
+    }
+
+
+def _attach_stats(node, stats):
+    node.stats = stats
+    for child in node.childNodes():
+        _attach_stats(child, stats)
+
+
+def _count_layers(node):
+    return sum(_count_layers(child) if child.childNodes() else 1 for child in node.childNodes())
+
+
+def _document_bounds(document):
+    rect = document.rootNode().bounds()
+    if rect.isEmpty():
+        return 0, 0, document.width(), document.height()
+    return rect.x(), rect.y(), rect.width(), rect.height()
+
+
+# =========================================================================================
+# ARRANQUE DEL DOCKER
+# =========================================================================================
+def startup(tracking=True, overlay=False, show=False, timeout=5.0, idle=0.0):
+    app = ensure_app()
+    plugin = load_plugin()
+    plugin.Krita.instance().document = synthetic_document()
+    settings = {"is_active": tracking, "size_index": 0, "source_index": 1, "overlay": overlay}
+    with tempfile.TemporaryDirectory() as folder:
+        settings_path = os.path.join(folder, "infinite_canvas_settings.txt")
+        with open(settings_path, "w") as f:
+            json.dump(settings, f)
+        t0 = time.perf_counter()
+        docker = plugin.CameraMonitorDocker(settings_path=settings_path)
+        constructed = time.perf_counter() - t0
+        if show:
+            docker.show()
+        if tracking or show:
+            # Bucle de eventos real: la proyección diferida espera a que quede ocioso
+            loop = QEventLoop()
+            poll = QTimer()
+            poll.timeout.connect(lambda: "first_projection_ms" in docker.stats and loop.quit())
+            poll.start(5)
+            QTimer.singleShot(int(timeout * 1000), loop.quit)
+            loop.exec_()
+            poll.stop()
+        if idle > 0:
+            # Sin entrada: los bucles de sondeo deberían ir espaciándose
+            loop = QEventLoop()
+            QTimer.singleShot(int(idle * 1000), loop.quit)
+            loop.exec_()
+        report = {"constructor_ms": constructed * 1000.0}
+        report.update(docker.current_stats())
+        docker.toggle_overlay(False)
+        if docker.interceptor:
+            app.removeEventFilter(docker.interceptor)
+        docker.deleteLater()
+        app.processEvents()
+    return report
+
+
+# =========================================================================================
+# COMPOSICIÓN: ESCALADO POR HILOS
+# =========================================================================================
+def bench(width=8000, height=6000, layers=4, max_workers=None, repeats=3, document=None):
+    ensure_app()
+    plugin = load_plugin()
+    stats = new_stats()
+    if document is None:
+        document = synthetic_document(width, height, layers=layers, stats=stats)
+    interceptor = plugin.InputInterceptor(plugin.ViewState(), None, None, plugin.TileOccupancyIndex())
+    x, y, w, h = _document_bounds(document)
+    max_workers = max_workers or os.cpu_count() or 1
+    report = {"pixels": w * h, "layers": _count_layers(document.rootNode())}
+    reference = None
+    baseline = None
+    # Pasada sin medir: decodificación de tiles (.kra) e índice de ocupación
+    interceptor.get_manual_projection(document, x, y, w, h)
+    for workers in range(1, max_workers + 1):
+        interceptor.compositor.set_workers(workers)
+        best = None
+        for _ in range(repeats):
+            # Sin bucle de eventos no hay fin de tick: cada repetición lee de nuevo
+            interceptor.broker.end_tick()
+            t0 = time.perf_counter()
+            image = interceptor.get_manual_projection(document, x, y, w, h)
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        if reference is None:
+            reference = image
+            baseline = best
+        elif image != reference:
+            raise RuntimeError(f"La composición con {workers} hilos no coincide con la de 1 hilo")
+        report[f"workers_{workers}_ms"] = best * 1000.0
+        report[f"workers_{workers}_speedup"] = baseline / best
+    interceptor.compositor.shutdown()
+    return report
+
+
+# =========================================================================================
+# EXPORTACIÓN
+# =========================================================================================
+def export(path, document=None, mode=1, width=4000, height=3000):
+    ensure_app()
+    plugin = load_plugin()
+    stats = new_stats()
+    if document is None:
+        document = synthetic_document(width, height, stats=stats)
+    else:
+        _attach_stats(document.rootNode(), stats)
+    interceptor = plugin.InputInterceptor(plugin.ViewState(), None, None, plugin.TileOccupancyIndex())
+    interceptor.set_mode(mode)
+    if mode == 0:
+        bounds = document.activeNode().bounds()
+        x, y, w, h = bounds.x(), bounds.y(), bounds.width(), bounds.height()
+    else:
+        x, y, w, h = _document_bounds(document)
+    t0 = time.perf_counter()
+    plugin.export_projection(interceptor, document, QRect(x, y, w, h), path)
+    interceptor.compositor.shutdown()
+    return {"file": path, "width": w, "height": h, "file_bytes": os.path.getsize(path),
+            "bytes_read": stats["bytes_read"], "wall_s": time.perf_counter() - t0}
+
+
+# =========================================================================================
+# DOCUMENTOS .KRA
+# =========================================================================================
+def inspect_kra(path, warm=True):
+    # Árbol de capas, coste de decodificar y, con warm, el de construir el
+    # índice de ocupación y la proyección completa (lo que pagaría el docker).
+    ensure_app()
+    stats = new_stats()
+    t0 = time.perf_counter()
+    document = read_kra(path, stats)
+    report = {"file": os.path.basename(path), "file_bytes": os.path.getsize(path),
+              "size": f"{document.width()}x{document.height()}",
+              "layers": _count_layers(document.rootNode()), "parse_ms": (time.perf_counter() - t0) * 1000.0}
+
+    def walk(node, depth):
+        for child in reversed(node.childNodes()):
+            b = child.bounds()
+            flags = "" if child.visible() else " (oculta)"
+            report[f"{'  ' * depth}{child.name()}"] = (
+                f"{child.type()} {child.blendingMode()} {child.opacity()} "
+                f"[{b.x()},{b.y()} {b.width()}x{b.height()}]{flags}")
+            walk(child, depth + 1)
+    walk(document.rootNode(), 0)
+    if not warm:
+        return report
+    plugin = load_plugin()
+    occupancy = plugin.TileOccupancyIndex()
+    interceptor = plugin.InputInterceptor(plugin.ViewState(), None, None, occupancy)
+    t0 = time.perf_counter()
+    content = QRect()
+
+    def crawl(node):
+        nonlocal content
+        for child in node.childNodes():
+            if not child.visible(): continue
+            content = content.united(occupancy.content_bounds(child))
+    crawl(document.rootNode())
+    report["occupancy_ms"] = (time.perf_counter() - t0) * 1000.0
+    report["content_bounds"] = f"[{content.x()},{content.y()} {content.width()}x{content.height()}]"
+    if not content.isEmpty():
+        t0 = time.perf_counter()
+        interceptor.get_manual_projection(document, content.x(), content.y(), content.width(), content.height())
+        report["projection_ms"] = (time.perf_counter() - t0) * 1000.0
+    interceptor.compositor.shutdown()
+    report["pixel_calls"] = stats["pixel_calls"]
+    report["bytes_read"] = stats["bytes_read"]
+    return report
+
+
+def print_report(report, as_json=False):
+    if as_json:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        print(f"{key:>18}: {value:.3f}" if isinstance(value, float) else f"{key:>18}: {value}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Infinite Canvas sin Krita")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_replay = sub.add_parser("replay", help="reproducir una grabación .icstroke")
+    p_replay.add_argument("recording")
+    p_replay.add_argument("--speed", type=float, default=1.0,
+                          help="1 = tiempo real, 4 = 4x más rápido, 0 = sin esperas")
+    p_replay.add_argument("--mode", choices=["layer", "full"], default=None,
+                          help="forzar modo de origen (por defecto el de la grabación)")
+    p_replay.add_argument("--kra", help="documento .kra en lugar del sintético")
+    p_replay.add_argument("--json", action="store_true")
+    p_startup = sub.add_parser("startup", help="medir el coste de arranque del docker")
+    p_startup.add_argument("--tracking", action="store_true", help="arrancar con el seguimiento activado")
+    p_startup.add_argument("--show", action="store_true", help="mostrar el docker (crea los widgets pesados)")
+    p_startup.add_argument("--idle", type=float, default=0.0,
+                           help="segundos en reposo tras arrancar (para medir despertares por segundo)")
+    p_startup.add_argument("--json", action="store_true")
+    p_bench = sub.add_parser("bench", help="medir la composición Full Document de 1 a N hilos")
+    p_bench.add_argument("--width", type=int, default=8000)
+    p_bench.add_argument("--height", type=int, default=6000)
+    p_bench.add_argument("--layers", type=int, default=4)
+    p_bench.add_argument("--max-workers", type=int, default=None)
+    p_bench.add_argument("--repeats", type=int, default=3)
+    p_bench.add_argument("--kra", help="documento .kra en lugar del sintético")
+    p_bench.add_argument("--json", action="store_true")
+    p_export = sub.add_parser("export", help="exportar por bandas a PNG el contenido completo")
+    p_export.add_argument("output")
+    p_export.add_argument("--mode", choices=["layer", "full"], default="full")
+    p_export.add_argument("--kra", help="documento .kra en lugar del sintético")
+    p_export.add_argument("--json", action="store_true")
+    p_kra = sub.add_parser("kra", help="leer un .kra: árbol de capas y coste de precalentar cachés")
+    p_kra.add_argument("document")
+    p_kra.add_argument("--no-warm", action="store_true", help="solo leer el árbol de capas")
+    p_kra.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+    document = read_kra(args.kra) if getattr(args, "kra", None) else None
+
+    if args.command == "replay":
+        mode = None if args.mode is None else (0 if args.mode == "layer" else 1)
+        print_report(replay(args.recording, document, args.speed, mode), args.json)
+    elif args.command == "startup":
+        print_report(startup(tracking=args.tracking, show=args.show, idle=args.idle), args.json)
+    elif args.command == "bench":
+        print_report(bench(args.width, args.height, args.layers, args.max_workers, args.repeats,
+                           document), args.json)
+    elif args.command == "export":
+        print_report(export(args.output, document, 0 if args.mode == "layer" else 1), args.json)
+    elif args.command == "kra":
+        print_report(inspect_kra(args.document, warm=not args.no_warm), args.json)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
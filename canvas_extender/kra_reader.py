@@ -0,0 +1,371 @@
+"""Lector de archivos .kra sin Krita.
+
+Abre el zip, lee el árbol de capas de maindoc.xml (desplazamientos,
+visibilidad, opacidad, modo de fusión y grupos) y decodifica los datos
+de píxeles teselados de cada capa. Los nodos exponen la misma interfaz que
+consumen get_manual_projection y calculate_total_bounds, así que la
+proyección, los benchmarks y el precalentado de cachés pueden correr en una
+máquina sin Krita contra documentos reales:
+
+    from kra_reader import read_kra
+    doc = read_kra("ilustracion.kra")
+    doc.rootNode().bounds()
+
+Limitaciones: las máscaras y las capas de ajuste no se aplican, y las capas
+vectoriales, de archivo o de relleno solo tienen píxeles si el .kra guarda
+su rasterizado junto a las demás capas.
+"""
+import xml.etree.ElementTree as ET
+import zipfile
+
+from PyQt5.QtCore import Qt, QRect, QUuid
+from PyQt5.QtGui import QImage, QPainter
+
+# nodetype de maindoc.xml -> Node.type() de la API de Krita
+NODE_TYPES = {
+    "paintlayer": "paintlayer",
+    "grouplayer": "grouplayer",
+    "shapelayer": "vectorlayer",
+    "generatorlayer": "filllayer",
+    "filelayer": "filelayer",
+    "clonelayer": "clonelayer",
+    "adjustmentlayer": "filterlayer",
+}
+
+# Solo para componer grupos: mismos modos que BLEND_MODES_MAP del plugin
+KRA_BLEND_MODES = {
+    "normal": QPainter.CompositionMode_SourceOver,
+    "multiply": QPainter.CompositionMode_Multiply,
+    "screen": QPainter.CompositionMode_Screen,
+    "overlay": QPainter.CompositionMode_Overlay,
+    "darken": QPainter.CompositionMode_Darken,
+    "lighten": QPainter.CompositionMode_Lighten,
+    "dodge": QPainter.CompositionMode_ColorDodge,
+    "burn": QPainter.CompositionMode_ColorBurn,
+    "hard_light": QPainter.CompositionMode_HardLight,
+    "soft_light": QPainter.CompositionMode_SoftLight,
+    "soft_light_svg": QPainter.CompositionMode_SoftLight,
+    "diff": QPainter.CompositionMode_Difference,
+    "exclusion": QPainter.CompositionMode_Exclusion,
+    "add": QPainter.CompositionMode_Plus,
+}
+
+
+class KraFormatError(ValueError):
+    pass
+
+
+def lzf_decompress(data, out_len):
+    # LZF tal como lo usa KisLzfCompression: literales (ctrl < 32) y
+    # referencias hacia atrás que pueden solaparse con lo que se escribe.
+    out = bytearray(out_len)
+    ip = op = 0
+    end = len(data)
+    while ip < end:
+        ctrl = data[ip]
+        ip += 1
+        if ctrl < 32:
+            ctrl += 1
+            if op + ctrl > out_len or ip + ctrl > end:
+                raise KraFormatError("Literal LZF fuera de rango")
+            out[op:op + ctrl] = data[ip:ip + ctrl]
+            ip += ctrl
+            op += ctrl
+            continue
+        length = ctrl >> 5
+        ref = op - ((ctrl & 0x1f) << 8) - 1
+        if length == 7:
+            length += data[ip]
+            ip += 1
+        ref -= data[ip]
+        ip += 1
+        length += 2
+        if ref < 0 or op + length > out_len:
+            raise KraFormatError("Referencia LZF fuera de rango")
+        if ref + length <= op:
+            out[op:op + length] = out[ref:ref + length]
+        else:
+            for k in range(length):
+                out[op + k] = out[ref + k]
+        op += length
+    if op != out_len:
+        raise KraFormatError(f"Tile LZF incompleto: {op} de {out_len} bytes")
+    return out
+
+
+def delinearize(data, pixel_size):
+    # Krita comprime los canales por planos (todos los B, luego los G...)
+    count = len(data) // pixel_size
+    out = bytearray(len(data))
+    for channel in range(pixel_size):
+        out[channel::pixel_size] = data[channel * count:(channel + 1) * count]
+    return out
+
+
+class KraLayerData:
+    # Datos teselados de una capa ("VERSION 2"). Los tiles se descomprimen
+    # la primera vez que se leen y se quedan en memoria.
+    def __init__(self, blob, default_pixel=None):
+        self.blob = blob
+        self.tile_width = 64
+        self.tile_height = 64
+        self.pixel_size = 4
+        self.tiles = {}
+        self.decoded = {}
+        self._parse()
+        if default_pixel is None or len(default_pixel) != self.pixel_size:
+            default_pixel = bytes(self.pixel_size)
+        self.default_pixel = bytes(default_pixel)
+
+    def _readline(self, pos):
+        end = self.blob.find(b"\n", pos)
+        if end < 0:
+            raise KraFormatError("Cabecera de capa truncada")
+        return self.blob[pos:end].decode("ascii").strip(), end + 1
+
+    def _parse(self):
+        pos = 0
+        header = {}
+        while "DATA" not in header:
+            line, pos = self._readline(pos)
+            key, _, value = line.partition(" ")
+            header[key] = value
+        if header.get("VERSION") != "2":
+            raise KraFormatError(f"Versión de datos de capa no soportada: {header.get('VERSION')}")
+        self.tile_width = int(header.get("TILEWIDTH", 64))
+        self.tile_height = int(header.get("TILEHEIGHT", 64))
+        self.pixel_size = int(header.get("PIXELSIZE", 4))
+        for _ in range(int(header["DATA"])):
+            line, pos = self._readline(pos)
+            x, y, _, size = line.split(",")
+            size = int(size)
+            self.tiles[(int(x), int(y))] = (pos, size)
+            pos += size
+
+    def extent(self):
+        rect = QRect()
+        for x, y in self.tiles:
+            rect = rect.united(QRect(x, y, self.tile_width, self.tile_height))
+        return rect
+
+    def tile(self, key):
+        data = self.decoded.get(key)
+        if data is None:
+            pos, size = self.tiles[key]
+            tile_bytes = self.tile_width * self.tile_height * self.pixel_size
+            if self.blob[pos] == 1:
+                data = delinearize(lzf_decompress(self.blob[pos + 1:pos + size], tile_bytes), self.pixel_size)
+            else:
+                data = self.blob[pos + 1:pos + 1 + tile_bytes]
+            self.decoded[key] = data
+        return data
+
+    def read(self, x, y, w, h):
+        ps = self.pixel_size
+        tw, th = self.tile_width, self.tile_height
+        out = bytearray(self.default_pixel * (w * h))
+        tx0, ty0 = (x // tw) * tw, (y // th) * th
+        for ty in range(ty0, y + h, th):
+            for tx in range(tx0, x + w, tw):
+                if (tx, ty) not in self.tiles: continue
+                tile = self.tile((tx, ty))
+                left, right = max(x, tx), min(x + w, tx + tw)
+                top, bottom = max(y, ty), min(y + h, ty + th)
+                n = (right - left) * ps
+                for row in range(top, bottom):
+                    src = ((row - ty) * tw + (left - tx)) * ps
+                    dst = ((row - y) * w + (left - x)) * ps
+                    out[dst:dst + n] = tile[src:src + n]
+        return bytes(out)
+
+
+class DocumentNode:
+    # Misma interfaz de nodo que consumen get_manual_projection y calculate_total_bounds.
+    # Base de KraNode y del StandInNode de headless.py: cada uno pone bounds,
+    # image y _read; pixelData cuenta las llamadas y los bytes en stats.
+    def __init__(self, name, node_type, x=0, y=0, opacity=255, blending_mode="normal",
+                 visible=True, uuid=None, children=None, stats=None):
+        self._name = name
+        self._type = node_type
+        self._x = x
+        self._y = y
+        self._opacity = opacity
+        self._blending_mode = blending_mode
+        self._visible = visible
+        self._uuid = QUuid(uuid) if uuid else QUuid.createUuid()
+        self._children = children or []
+        self._parent = None
+        for child in self._children:
+            child._parent = self
+        self.stats = stats
+
+    def name(self): return self._name
+    def uniqueId(self): return self._uuid
+    def type(self): return self._type
+    def visible(self): return self._visible
+    def opacity(self): return self._opacity
+    def blendingMode(self): return self._blending_mode
+    def childNodes(self): return list(self._children)
+    def parentNode(self): return self._parent
+
+    def pixelData(self, x, y, w, h):
+        data = self._read(x, y, w, h) if w > 0 and h > 0 else b""
+        if self.stats is not None:
+            self.stats["pixel_calls"] += 1
+            self.stats["bytes_read"] += len(data)
+        return data
+
+    def _read(self, x, y, w, h):
+        return bytes(w * h * 4)
+
+
+class Document:
+    def __init__(self, name, width, height, root, resolution=72.0, active=None, path=None):
+        self._name = name
+        self._width = width
+        self._height = height
+        self._root = root
+        self._resolution = resolution
+        self._active = active
+        self._path = path
+
+    def name(self): return self._name
+    def fileName(self): return self._path
+    def width(self): return self._width
+    def height(self): return self._height
+    def resolution(self): return self._resolution
+    def rootNode(self): return self._root
+    def activeNode(self): return self._active
+
+
+class KraNode(DocumentNode):
+    def __init__(self, name, node_type, x=0, y=0, opacity=255, blending_mode="normal",
+                 visible=True, uuid=None, data=None, children=None, stats=None):
+        super().__init__(name, node_type, x, y, opacity, blending_mode, visible, uuid, children, stats)
+        self._data = data
+
+    def position(self): return self._x, self._y
+
+    def bounds(self):
+        if self._type == "grouplayer":
+            rect = QRect()
+            for child in self._children:
+                if child.visible():
+                    rect = rect.united(child.bounds())
+            return rect
+        if self._data is None:
+            return QRect()
+        return self._data.extent().translated(self._x, self._y)
+
+    def _read(self, x, y, w, h):
+        if self._type == "grouplayer":
+            # Como en Krita: el pixelData de un grupo es su proyección
+            image = self.image(x, y, w, h).convertToFormat(QImage.Format_ARGB32)
+            return image.constBits().asstring(image.sizeInBytes())
+        if self._data is None:
+            return bytes(w * h * 4)
+        return self._data.read(x - self._x, y - self._y, w, h)
+
+    def image(self, x, y, w, h):
+        # QImage premultiplicada del rectángulo (coordenadas de documento)
+        if self._type == "grouplayer":
+            image = QImage(w, h, QImage.Format_ARGB32_Premultiplied)
+            image.fill(Qt.transparent)
+            painter = QPainter(image)
+            for child in self._children:
+                if not child.visible(): continue
+                child_rect = child.bounds().intersected(QRect(x, y, w, h))
+                if child_rect.isEmpty(): continue
+                painter.setOpacity(child.opacity() / 255.0)
+                painter.setCompositionMode(KRA_BLEND_MODES.get(child.blendingMode(),
+                                                               QPainter.CompositionMode_SourceOver))
+                painter.drawImage(child_rect.x() - x, child_rect.y() - y,
+                                  child.image(child_rect.x(), child_rect.y(),
+                                              child_rect.width(), child_rect.height()))
+            painter.end()
+            return image
+        pixel_size = self._data.pixel_size if self._data is not None else 4
+        data = self._data.read(x - self._x, y - self._y, w, h) if self._data is not None else bytes(w * h * 4)
+        if pixel_size == 4:
+            image = QImage(data, w, h, w * 4, QImage.Format_ARGB32)
+        elif pixel_size == 8:
+            image = QImage(data, w, h, w * 8, QImage.Format_RGBA64).rgbSwapped()
+        else:
+            # Espacios de color en coma flotante: no se componen
+            image = QImage(w, h, QImage.Format_ARGB32)
+            image.fill(Qt.transparent)
+        return image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+
+    def thumbnail(self, w, h):
+        rect = self.bounds()
+        if rect.isEmpty(): return QImage()
+        image = self.image(rect.x(), rect.y(), rect.width(), rect.height())
+        return image.scaled(w, h, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+
+class KraDocument(Document):
+    pass
+
+
+def _parse_maindoc(data):
+    # Krita escribe <DOC xmlns="http://www.calligra.org/DTD/krita">: se quita
+    # el espacio de nombres para que find/findall funcionen con nombres simples
+    root = ET.fromstring(data)
+    for element in root.iter():
+        if isinstance(element.tag, str) and element.tag.startswith("{"):
+            element.tag = element.tag.split("}", 1)[1]
+    return root
+
+
+def _parse_layers(element, archive, prefix, names, stats, selected):
+    # maindoc.xml lista de arriba a abajo; childNodes() va de abajo a arriba
+    nodes = []
+    layers = element.find("layers")
+    if layers is None:
+        return nodes
+    for item in layers.findall("layer"):
+        node_type = NODE_TYPES.get(item.get("nodetype"), item.get("nodetype", "paintlayer"))
+        children = None
+        data = None
+        if node_type == "grouplayer":
+            children = _parse_layers(item, archive, prefix, names, stats, selected)
+        else:
+            member = f"{prefix}/layers/{item.get('filename', '')}"
+            if member in names:
+                default = archive.read(member + ".defaultpixel") if member + ".defaultpixel" in names else None
+                data = KraLayerData(archive.read(member), default)
+        node = KraNode(item.get("name", ""), node_type,
+                       x=int(float(item.get("x", 0))), y=int(float(item.get("y", 0))),
+                       opacity=int(item.get("opacity", 255)),
+                       blending_mode=item.get("compositeop", "normal"),
+                       visible=item.get("visible", "1") not in ("0", "false"),
+                       uuid=item.get("uuid"), data=data, children=children, stats=stats)
+        if item.get("selected") == "true":
+            selected.append(node)
+        nodes.append(node)
+    nodes.reverse()
+    return nodes
+
+
+def _topmost_paint_layer(node):
+    for child in reversed(node.childNodes()):
+        found = child if child.type() == "paintlayer" else _topmost_paint_layer(child)
+        if found is not None:
+            return found
+    return None
+
+
+def read_kra(path, stats=None):
+    with zipfile.ZipFile(path) as archive:
+        names = set(archive.namelist())
+        if "maindoc.xml" not in names:
+            raise KraFormatError(f"{path}: falta maindoc.xml")
+        image = _parse_maindoc(archive.read("maindoc.xml")).find("IMAGE")
+        if image is None:
+            raise KraFormatError(f"{path}: maindoc.xml sin IMAGE")
+        selected = []
+        children = _parse_layers(image, archive, image.get("name", ""), names, stats, selected)
+    root = KraNode("root", "grouplayer", children=children, stats=stats)
+    active = selected[0] if selected else _topmost_paint_layer(root)
+    return KraDocument(image.get("name", ""), int(image.get("width", 0)), int(image.get("height", 0)),
+                       root, float(image.get("x-res", 72.0)), active, path)
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "canvas_extender"))
+
+import headless  # noqa: E402
+
+# Referencia viva: si la QApplication se recolecta, crear widgets aborta
+APP = headless.ensure_app()
+
+
+@pytest.fixture(scope="session")
+def plugin():
+    # canvas_extender.py cargado con el módulo krita sustituto de headless.py
+    return headless.load_plugin()
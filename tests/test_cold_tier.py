@@ -0,0 +1,59 @@
+import os
+
+import pytest
+from PyQt5.QtCore import QRect
+from PyQt5.QtGui import QColor, QImage
+
+import headless
+
+TILE = 64 * 64 * 4
+
+
+@pytest.mark.parametrize("data, kind", [
+    (bytes(TILE), "T"),
+    (bytes((10, 20, 30, 255)) * (TILE // 4), "S"),
+    (os.urandom(TILE), "Z"),
+    (bytes(TILE - 4) + bytes((0, 0, 0, 1)), "Z"),
+])
+def test_pack_tile_round_trip(plugin, data, kind):
+    packed = plugin.pack_tile(data)
+    assert packed[0] == kind
+    assert plugin.unpack_tile(packed) == data
+
+
+def test_cold_store_take_and_discard(plugin):
+    store = plugin.ColdTileStore(budget=1 << 20)
+    solid = bytes((1, 2, 3, 4)) * (TILE // 4)
+    assert store.put("a", solid) == []
+    assert store.put("b", bytes(TILE)) == []
+    assert "a" in store and store.raw == 2 * TILE
+    assert store.take("a") == solid
+    assert "a" not in store and store.take("a") is None
+    store.discard("b")
+    assert (store.used, store.raw, len(store.entries)) == (0, 0, 0)
+
+
+def test_cold_store_evicts_oldest_over_budget(plugin):
+    noise = [os.urandom(TILE) for _ in range(3)]
+    store = plugin.ColdTileStore(budget=2 * plugin.packed_size(plugin.pack_tile(noise[0])) + 64)
+    assert store.put(0, noise[0]) == []
+    assert store.put(1, noise[1]) == []
+    assert store.put(2, noise[2]) == [0]
+    assert 0 not in store and store.take(2) == noise[2]
+    # Reemplazar una clave no cuenta dos veces
+    store.put(1, bytes(TILE))
+    assert store.raw == TILE and store.take(1) == bytes(TILE)
+
+
+def test_raster_cache_serves_from_cold_tier(plugin):
+    image = QImage(256, 64, QImage.Format_ARGB32)
+    image.fill(QColor(200, 100, 50))
+    stats = headless.new_stats()
+    node = headless.StandInNode("vector", image, node_type="vectorlayer", stats=stats)
+    cache = plugin.RasterLayerCache(tile_size=64, budget=2 * TILE)
+    first = dict((rect.getRect(), bytes(data)) for rect, data in cache.chunks(node, [QRect(0, 0, 256, 64)]))
+    assert len(first) == 4 and len(cache.cold.entries) == 2
+    calls = stats["pixel_calls"]
+    again = dict((rect.getRect(), bytes(data)) for rect, data in cache.chunks(node, [QRect(0, 0, 256, 64)]))
+    assert again == first
+    assert stats["pixel_calls"] == calls
@@ -0,0 +1,35 @@
+import os
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QColor, QImage
+
+
+def band(width, rows, color):
+    image = QImage(width, rows, QImage.Format_ARGB32_Premultiplied)
+    image.fill(color)
+    return image
+
+
+def test_bands_decode_as_one_png(plugin, tmp_path, monkeypatch):
+    # IDAT pequeños para que la imagen quede repartida en varios chunks
+    monkeypatch.setattr(plugin, "EXPORT_IDAT_SIZE", 97)
+    path = str(tmp_path / "bandas.png")
+    writer = plugin.StreamingPngWriter(path, 37, 30)
+    writer.write_rows(band(37, 10, QColor(255, 0, 0)))
+    writer.write_rows(band(37, 20, QColor(0, 0, 255, 128)))
+    writer.close()
+    assert writer.rows_written == 30
+    image = QImage(path)
+    assert (image.width(), image.height()) == (37, 30)
+    assert QColor.fromRgba(image.pixel(36, 9)).getRgb() == (255, 0, 0, 255)
+    top, bottom = QColor.fromRgba(image.pixel(0, 10)), QColor.fromRgba(image.pixel(36, 29))
+    assert top.alpha() == bottom.alpha() == 128
+    assert top.blue() >= 254 and top.red() == 0
+
+
+def test_abort_removes_partial_file(plugin, tmp_path):
+    path = str(tmp_path / "cancelado.png")
+    writer = plugin.StreamingPngWriter(path, 8, 8)
+    writer.write_rows(band(8, 4, Qt.transparent))
+    writer.abort()
+    assert not os.path.exists(path)
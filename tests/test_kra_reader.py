@@ -0,0 +1,116 @@
+import zipfile
+
+import pytest
+
+from kra_reader import KraFormatError, lzf_decompress, read_kra
+
+TILE = 64
+
+
+def lzf_runs(data):
+    # Compresor LZF mínimo: un literal por byte nuevo y referencias a
+    # distancia 1 (solapadas) para repetirlo, como en un tile de color plano.
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        out += bytes([0, data[i]])
+        i += 1
+        while i < len(data) and data[i] == data[i - 1]:
+            run = 1
+            while i + run < len(data) and data[i + run] == data[i - 1] and run < 264:
+                run += 1
+            if run < 3:
+                break
+            length = run - 2
+            if length >= 7:
+                out += bytes([7 << 5, length - 7, 0])
+            else:
+                out += bytes([length << 5, 0])
+            i += run
+    return bytes(out)
+
+
+def solid_tile(bgra):
+    # Tile plano por canales (todos los B, luego los G...), como lo comprime Krita
+    planar = b"".join(bytes([channel]) * (TILE * TILE) for channel in bgra)
+    return b"\x01" + lzf_runs(planar)
+
+
+def layer_blob(tiles):
+    parts = [f"VERSION 2\nTILEWIDTH {TILE}\nTILEHEIGHT {TILE}\nPIXELSIZE 4\nDATA {len(tiles)}\n".encode()]
+    for (x, y), tile in tiles.items():
+        parts.append(f"{x},{y},LZF,{len(tile)}\n".encode())
+        parts.append(tile)
+    return b"".join(parts)
+
+
+MAINDOC = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE DOC PUBLIC '-//KDE//DTD krita 2.0//EN' 'http://www.calligra.org/DTD/krita-2.0.dtd'>
+<DOC xmlns="http://www.calligra.org/DTD/krita" syntaxVersion="2.0" kritaVersion="5.2.2" editor="Krita">
+ <IMAGE name="prueba" width="200" height="100" x-res="300" y-res="300" colorspacename="RGBA" mime="application/x-kra">
+  <layers>
+   <layer name="Tinta" nodetype="paintlayer" filename="layer3" x="0" y="0" opacity="255"
+          compositeop="normal" visible="1" uuid="{11111111-1111-1111-1111-111111111111}" selected="true"/>
+   <layer name="Grupo" nodetype="grouplayer" filename="layer2" x="0" y="0" opacity="255"
+          compositeop="normal" visible="1" uuid="{22222222-2222-2222-2222-222222222222}">
+    <layers>
+     <layer name="Fondo" nodetype="paintlayer" filename="layer1" x="-64" y="0" opacity="128"
+            compositeop="multiply" visible="1" uuid="{33333333-3333-3333-3333-333333333333}"/>
+    </layers>
+   </layer>
+  </layers>
+ </IMAGE>
+</DOC>
+"""
+
+
+@pytest.fixture
+def kra_path(tmp_path):
+    path = tmp_path / "prueba.kra"
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("mimetype", "application/x-krita")
+        archive.writestr("maindoc.xml", MAINDOC)
+        archive.writestr("prueba/layers/layer1", layer_blob({(0, 0): solid_tile((10, 20, 30, 255)),
+                                                            (64, 0): solid_tile((40, 50, 60, 255))}))
+        archive.writestr("prueba/layers/layer3", layer_blob({(128, 64): solid_tile((0, 0, 255, 200))}))
+    return str(path)
+
+
+def test_lzf_overlapping_backreference():
+    data = bytes([7]) * 300 + bytes([1, 2, 3])
+    assert bytes(lzf_decompress(lzf_runs(data), len(data))) == data
+
+
+def test_namespaced_layer_tree(kra_path):
+    doc = read_kra(kra_path)
+    assert (doc.name(), doc.width(), doc.height(), doc.resolution()) == ("prueba", 200, 100, 300.0)
+    # childNodes() va de abajo a arriba, al revés que maindoc.xml
+    group, ink = doc.rootNode().childNodes()
+    assert (group.name(), group.type()) == ("Grupo", "grouplayer")
+    assert (ink.name(), ink.type()) == ("Tinta", "paintlayer")
+    (background,) = group.childNodes()
+    assert background.parentNode() is group
+    assert (background.opacity(), background.blendingMode()) == (128, "multiply")
+    assert doc.activeNode() is ink
+
+
+def test_tile_decode_and_offsets(kra_path):
+    doc = read_kra(kra_path)
+    group, ink = doc.rootNode().childNodes()
+    (background,) = group.childNodes()
+    # Los tiles están en coordenadas de capa; x="-64" desplaza la capa
+    assert background.bounds().getRect() == (-64, 0, 128, 64)
+    assert ink.bounds().getRect() == (128, 64, 64, 64)
+    assert background.pixelData(-64, 0, 1, 1) == bytes((10, 20, 30, 255))
+    assert background.pixelData(-1, 63, 2, 1) == bytes((10, 20, 30, 255, 40, 50, 60, 255))
+    # Fuera de los tiles: el píxel por defecto (transparente)
+    assert background.pixelData(64, 0, 1, 1) == bytes(4)
+    assert ink.pixelData(130, 70, 1, 1) == bytes((0, 0, 255, 200))
+
+
+def test_missing_image_is_rejected(tmp_path):
+    path = tmp_path / "roto.kra"
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("maindoc.xml", '<DOC xmlns="http://www.calligra.org/DTD/krita"/>')
+    with pytest.raises(KraFormatError):
+        read_kra(str(path))
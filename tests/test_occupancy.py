@@ -0,0 +1,144 @@
+import json
+
+import pytest
+from PyQt5.QtCore import QRect, Qt
+from PyQt5.QtGui import QColor, QImage, QPainter
+
+import headless
+
+TS = 64
+
+
+def layer(w=512, h=512, x=0, y=0, blocks=()):
+    image = QImage(w, h, QImage.Format_ARGB32)
+    image.fill(Qt.transparent)
+    node = headless.StandInNode("capa", image, x=x, y=y)
+    for rect in blocks:
+        paint(node, rect)
+    return node
+
+
+def paint(node, rect):
+    # rect en coordenadas de documento
+    painter = QPainter(node._image)
+    painter.fillRect(rect.translated(-node._x, -node._y), QColor(200, 30, 30))
+    painter.end()
+
+
+def pixel(node, x, y):
+    return node.pixelData(x, y, 1, 1)
+
+
+def covers(rects, x, y):
+    return any(r.contains(x, y) for r in rects)
+
+
+@pytest.fixture(params=["numpy", "python"])
+def index(request, plugin, monkeypatch):
+    if request.param == "python":
+        monkeypatch.setattr(plugin, "np", None)
+    elif plugin.np is None:
+        pytest.skip("sin numpy")
+    return plugin.TileOccupancyIndex(tile_size=TS)
+
+
+def test_content_bounds_are_tight(index):
+    node = layer(blocks=[QRect(70, 10, 20, 20), QRect(300, 200, 5, 5)])
+    assert index.content_bounds(node) == QRect(64, 0, 256, 256)
+
+
+def test_occupied_tiles_unaligned_rect(index):
+    node = layer(x=-30, y=-30, blocks=[QRect(-30, -30, 1, 1), QRect(130, 70, 1, 1)])
+    rect = QRect(-30, -30, 200, 120)
+    data = node.pixelData(rect.x(), rect.y(), rect.width(), rect.height())
+    assert index._occupied_tiles(data, rect) == {(-1, -1), (2, 1)}
+
+
+def test_occupied_rects_skip_empty_tiles(index):
+    node = layer(blocks=[QRect(0, 0, 10, 10)])
+    index.content_bounds(node)
+    rects = index.occupied_rects(node, QRect(0, 0, 512, 512))
+    assert rects == [QRect(0, 0, TS, TS)]
+
+
+def test_dirty_marks_reach_parent_groups(index):
+    child = layer()
+    group = headless.StandInNode("grupo", node_type="grouplayer", children=[child])
+    # El grupo se lee como una capa más: su pixelData es el del hijo
+    group.pixelData = child.pixelData
+    group.bounds = child.bounds
+    index.content_bounds(group)
+    paint(child, QRect(500, 500, 4, 4))
+    index.mark_dirty(child, QRect(480, 480, 32, 32))
+    assert covers(index.occupied_rects(group, QRect(0, 0, 512, 512)), 500, 500)
+
+
+def test_record_replaces_stale_entry(index):
+    node = layer(blocks=[QRect(0, 0, 10, 10)])
+    index.content_bounds(node)
+    # Editado sin trazo observado (filtro, relleno...): el índice no lo sabe
+    paint(node, QRect(400, 400, 64, 64))
+    assert not covers(index.occupied_rects(node, QRect(0, 0, 512, 512)), 420, 420)
+    index.record(node, [(node.bounds(), node.pixelData(0, 0, 512, 512))])
+    assert covers(index.occupied_rects(node, QRect(0, 0, 512, 512)), 420, 420)
+    assert index.content_bounds(node) == QRect(0, 0, 512, 512)
+
+
+def test_partial_record_only_clears_fully_read_tiles(index):
+    node = layer(blocks=[QRect(0, 0, 10, 10), QRect(200, 0, 10, 10)])
+    index.content_bounds(node)
+    paint(node, QRect(300, 300, 10, 10))
+    index.record(node, [(QRect(250, 250, 100, 100), node.pixelData(250, 250, 100, 100))])
+    tiles = next(iter(index.layers.values()))["tiles"]
+    assert {(0, 0), (3, 0), (4, 4)} <= tiles
+
+
+@pytest.fixture
+def docker(plugin, tmp_path):
+    document = headless.synthetic_document(1200, 900, layers=2)
+    plugin.Krita.instance().document = document
+    settings = tmp_path / "settings.txt"
+    settings.write_text(json.dumps({"source_index": 1}))
+    docker = plugin.CameraMonitorDocker(settings_path=str(settings))
+    docker.ensure_initialized()
+    yield docker
+    docker.deleteLater()
+
+
+def empty_tile(docker, node):
+    entry = docker.occupancy.layers[headless_key(node)]
+    bounds = node.bounds()
+    for ty in range(bounds.top() // TS + 1, bounds.bottom() // TS):
+        for tx in range(bounds.left() // TS + 1, bounds.right() // TS):
+            if (tx, ty) not in entry["tiles"]:
+                return QRect(tx * TS, ty * TS, TS, TS)
+    pytest.skip("capa sin tiles vacíos")
+
+
+def headless_key(node):
+    return node.uniqueId().toString()
+
+
+def test_forced_refresh_revalidates_index(docker):
+    document = docker.interceptor.app_ref.activeDocument()
+    node = document.rootNode().childNodes()[-1]
+    docker.update_full_canvas(force=True)
+    block = empty_tile(docker, node)
+    paint(node, block)
+    # Otra vuelta del bucle de eventos: lo leído en la anterior caduca
+    docker.interceptor.broker.end_tick()
+    docker.update_full_canvas(force=True)
+    x, y = block.center().x(), block.center().y()
+    projection = docker.interceptor.get_manual_projection(document, x, y, 1, 1)
+    assert QColor.fromRgba(projection.pixel(0, 0)).alpha() > 0
+    assert docker.view_state.src_rect.contains(x, y)
+
+
+def test_disabling_tracking_drops_index(docker):
+    docker.update_full_canvas(force=True)
+    assert docker.occupancy.layers
+    docker.btn_active.setChecked(True)
+    docker.toggle_tracking()
+    docker.btn_active.setChecked(False)
+    docker.toggle_tracking()
+    assert not docker.occupancy.layers
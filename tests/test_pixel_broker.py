@@ -0,0 +1,129 @@
+import random
+
+import pytest
+from PyQt5.QtCore import QRect
+from PyQt5.QtGui import QColor, QImage, QPainter, QRegion
+
+import headless
+
+
+@pytest.fixture
+def node():
+    # Píxeles distintos en cada posición para comprobar vistas y recortes
+    rng = random.Random(3)
+    image = QImage(1280, 256, QImage.Format_ARGB32)
+    for y in range(0, 256, 8):
+        for x in range(0, 1280, 8):
+            image.setPixel(x, y, rng.getrandbits(32))
+    image = image.scaled(1280, 256)
+    return headless.StandInNode("capa", image, stats=headless.new_stats())
+
+
+def direct(node, rect):
+    image = node._image.copy(rect)
+    return image.constBits().asstring(rect.width() * rect.height() * 4)
+
+
+def test_merge_rects_respects_waste(plugin):
+    a, b, far = QRect(0, 0, 64, 64), QRect(64, 0, 64, 64), QRect(0, 640, 64, 64)
+    groups = plugin.merge_rects([a, b, far])
+    assert sorted(g[0].getRect() for g in groups) == [(0, 0, 128, 64), (0, 640, 64, 64)]
+    # Diagonal: la unión dobla el área, por encima del 25 % de desperdicio
+    groups = plugin.merge_rects([QRect(0, 0, 64, 64), QRect(64, 64, 64, 64)])
+    assert len(groups) == 2
+
+
+def test_disjoint_regions_never_overlap(plugin):
+    rng = random.Random(7)
+    rects = [QRect(rng.randrange(0, 900), rng.randrange(0, 900), rng.randrange(1, 200), rng.randrange(1, 200))
+             for _ in range(60)]
+    regions = plugin.disjoint_regions(rects)
+    for i, a in enumerate(regions):
+        assert not any(a.intersects(b) for b in regions[i + 1:])
+    covered = QRegion()
+    for region in regions:
+        covered = covered.united(QRegion(region))
+    assert all(QRegion(r).subtracted(covered).isEmpty() for r in rects)
+
+
+def test_pixel_view_matches_direct_read(plugin, node):
+    region = QRect(100, 20, 300, 100)
+    data = direct(node, region)
+    assert plugin.pixel_view(region, data, region) is data
+    full_rows = QRect(100, 50, 300, 10)
+    assert bytes(plugin.pixel_view(region, data, full_rows)) == direct(node, full_rows)
+    inner = QRect(150, 30, 17, 41)
+    assert bytes(plugin.pixel_view(region, data, inner)) == direct(node, inner)
+
+
+def test_lookup_assembles_from_several_regions(plugin, node):
+    broker = plugin.PixelReadBroker()
+    broker.read(node, QRect(0, 0, 600, 100))
+    broker.read(node, QRect(500, 0, 400, 100))
+    calls = node.stats["pixel_calls"]
+    rect = QRect(550, 10, 200, 50)
+    assert broker.read(node, rect) == direct(node, rect)
+    assert node.stats["pixel_calls"] == calls
+    # Un hueco sin leer: no se puede montar
+    assert broker._lookup(plugin.node_key(node), QRect(550, 10, 200, 150)) is None
+
+
+def test_merged_reads_do_not_overlap_cached_rects(plugin, node):
+    broker = plugin.PixelReadBroker()
+    broker.read(node, QRect(960, 0, 256, 256))
+    wanted = [QRect(1024, 0, 128, 64), QRect(0, 0, 896, 64), QRect(0, 64, 1152, 64)]
+    chunks = broker.read_many(node, wanted, merged=True)
+    rects = [rect for rect, _ in chunks]
+    for i, a in enumerate(rects):
+        assert not any(a.intersects(b) for b in rects[i + 1:])
+    for rect, data in chunks:
+        assert bytes(data) == direct(node, rect)
+
+
+def test_merged_composition_is_single_coverage(plugin, node):
+    # Con opacidad < 1 un píxel pintado dos veces se nota
+    broker = plugin.PixelReadBroker()
+    broker.read(node, QRect(960, 0, 256, 256))
+    view = QRect(0, 0, 1280, 128)
+    chunks = broker.read_many(node, [QRect(1024, 0, 128, 64), QRect(0, 0, 896, 64), QRect(0, 64, 1152, 64)],
+                              merged=True)
+    image = QImage(view.size(), QImage.Format_ARGB32_Premultiplied)
+    image.fill(0)
+    plugin.ProjectionCompositor(workers=1).compose(image, view, [(0.5, QPainter.CompositionMode_SourceOver, chunks)])
+    # Referencia: cada píxel cubierto por algún trozo se pinta una sola vez
+    covered = QRegion()
+    for rect, _ in chunks:
+        covered = covered.united(QRegion(rect))
+    reference = QImage(view.size(), QImage.Format_ARGB32_Premultiplied)
+    reference.fill(0)
+    painter = QPainter(reference)
+    painter.setOpacity(0.5)
+    for rect in covered.rects():
+        painter.drawImage(rect.topLeft(), node._image.copy(rect))
+    painter.end()
+    assert image == reference
+
+
+def test_bypass_rereads_and_replaces_stale_bytes(plugin, node):
+    broker = plugin.PixelReadBroker()
+    rect = QRect(10, 10, 64, 64)
+    before = broker.read(node, rect)
+    painter = QPainter(node._image)
+    painter.fillRect(rect, QColor(1, 2, 3))
+    painter.end()
+    assert broker.read(node, rect) == before
+    broker.bypass = True
+    fresh = broker.read(node, rect)
+    broker.bypass = False
+    assert fresh == direct(node, rect) != before
+    assert broker.read(node, QRect(20, 20, 8, 8)) == direct(node, QRect(20, 20, 8, 8))
+
+
+def test_reads_without_eviction_keep_earlier_regions(plugin, node):
+    broker = plugin.PixelReadBroker(budget=300 * 256 * 4)
+    kept = QRect(0, 0, 256, 256)
+    broker.read(node, kept)
+    broker.read(node, QRect(512, 0, 256, 256), evict=False)
+    calls = node.stats["pixel_calls"]
+    broker.read(node, kept)
+    assert node.stats["pixel_calls"] == calls